@@ -16,8 +16,16 @@ from ._api import get_current_user, get_user_statuses, get_user, create_user, ge
     is_user_status_change_notification_enabled, get_admin_users, on_role_pre_save, on_role_save, on_role_pre_delete, \
     on_role_delete, on_user_pre_save, on_user_save, on_user_create, on_user_pre_delete, on_user_delete, \
     on_user_status_change, get_new_user_roles, get_user_access_tokens, on_sign_in, on_sign_out, on_sign_up, \
-    on_user_as_jsonable
-from ._model import AuthEntity, AbstractRole, AbstractUser
+    on_user_as_jsonable, revoke_access_tokens, revoke_user_access_tokens, \
+    flush_access_tokens_prolongations, get_access_tokens_cache_stats, register_invalidation_bus, \
+    get_invalidation_bus, subscribe_invalidation, publish_invalidation, get_access_tokens_info, \
+    get_users_by_access_tokens, hash_password_async, verify_password_async, get_password_hasher_stats, \
+    register_password_hasher, get_password_hasher, password_needs_rehash, calibrate_password_hasher, identity_map, \
+    get_user_lookup_keys, get_users, find_users_page, find_roles_page, register_user_counter, get_user_count, \
+    reconcile_user_counters, insert_users, batch, build_users_bloom_filter
+from ._model import AuthEntity, AbstractRole, AbstractUser, PartialUser
+from ._memory_storage import MemoryStorage
+from ._sqlite_storage import SqliteStorage
 from ._api import USER_STATUS_ACTIVE, USER_STATUS_WAITING, USER_STATUS_DISABLED
 from ._model import SYSTEM_USER_LOGIN, ANONYMOUS_USER_LOGIN, LOGIN_MAX_LENGTH, NICKNAME_MAX_LENGTH, \
     FIRST_NAME_MAX_LENGTH, MIDDLE_NAME_MAX_LENGTH, LAST_NAME_MAX_LENGTH, COUNTRY_MAX_LENGTH, POSTAL_CODE_MAX_LENGTH, \
@@ -28,7 +36,8 @@ from ._model import SYSTEM_USER_LOGIN, ANONYMOUS_USER_LOGIN, LOGIN_MAX_LENGTH, N
 def plugin_load():
     """Init wrapper
     """
-    from pytsite import cron
+    from os import path
+    from pytsite import reg, cron, router
     from plugins import permissions
     from . import _eh
 
@@ -39,6 +48,28 @@ def plugin_load():
     on_register_storage_driver(_eh.on_register_storage_driver)
     cron.on_start(switch_user_to_system)
     cron.on_stop(restore_user)
+    on_user_create(_eh.on_user_create)
+    on_user_pre_save(_eh.on_user_pre_save)
+    on_user_save(_eh.on_user_save)
+    on_user_status_change(_eh.on_user_status_change)
+    on_user_delete(_eh.on_user_delete)
+    on_role_save(_eh.on_role_save)
+    on_role_delete(_eh.on_role_delete)
+    router.on_dispatch(_eh.on_router_dispatch)
+    router.on_response(_eh.on_router_response)
+    router.on_exception(_eh.on_router_response)
+    cron.every_min(flush_access_tokens_prolongations)
+    cron.hourly(reconcile_user_counters)
+    if reg.get('auth.users_bloom_filter_enabled', False):
+        cron.every_min(build_users_bloom_filter)
+
+    # Built-in storage drivers
+    storage_driver = reg.get('auth.storage_driver')
+    if storage_driver == 'memory':
+        register_storage_driver(MemoryStorage())
+    elif storage_driver == 'sqlite':
+        register_storage_driver(SqliteStorage(reg.get('auth.storage_sqlite_path',
+                                                      path.join(reg.get('paths.storage'), 'auth.sqlite3'))))
 
 
 def plugin_load_console():
@@ -50,3 +81,5 @@ def plugin_load_console():
     console.register_command(_cc.UserMod())
     console.register_command(_cc.Passwd())
     console.register_command(_cc.UserDel())
+    console.register_command(_cc.Import())
+    console.register_command(_cc.Export())
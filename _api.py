@@ -4,12 +4,16 @@ __author__ = 'Oleksandr Shepetko'
 __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
-from typing import Dict, Iterator, List, Tuple, Optional
+from typing import Awaitable, Dict, Iterable, Iterator, List, Tuple, Optional, Union
 from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from time import time
+from threading import Lock
 from pytsite import reg, lang, cache, events, util, validation, threading
 from plugins import query
-from . import _error, _model, _driver
+from . import _error, _model, _driver, _token, _local_cache, _password, _throttle, _identity_map, _counter, \
+    _pagination, _batch
 
 USER_STATUS_ACTIVE = 'active'
 USER_STATUS_WAITING = 'waiting'
@@ -23,10 +27,44 @@ permissions = []
 _anonymous_user = None
 _system_user = None
 _access_tokens = cache.create_pool('auth.access_tokens')  # token: token_info
-_user_access_tokens = cache.create_pool('auth.user_access_tokens')  # user.uid: tokens
+_user_access_tokens = cache.create_pool('auth.user_access_tokens_index')  # user.uid: {token: expires}
+_legacy_user_access_tokens = cache.create_pool('auth.user_access_tokens')  # user.uid: tokens, used up to 3.17
+_revoked_access_tokens = cache.create_pool('auth.revoked_access_tokens')  # signed token's signature: True
+_access_tokens_last_use = cache.create_pool('auth.access_tokens_last_use')  # user.uid: {token: last_use}
 _current_user = {}  # Current users, per thread
 _previous_user = {}  # Previous users, per thread
 _access_token_ttl = reg.get('auth.access_token_ttl', 86400)  # 24 hours
+_access_token_type = reg.get('auth.access_token_type', 'random')  # 'random' or 'signed'
+_access_token_compact_records = reg.get('auth.access_token_compact_records', True)
+_max_tokens_per_user = reg.get('auth.max_tokens_per_user', 0)  # 0 means unlimited
+_access_token_last_use_resolution = reg.get('auth.access_token_last_use_resolution', 60)  # seconds
+_access_token_prolong_threshold = reg.get('auth.access_token_prolong_threshold', 0.0)  # fraction of TTL
+_access_token_prolong_buffer_size = reg.get('auth.access_token_prolong_buffer_size', 0)  # 0 means no buffering
+_access_token_prolong_buffer_ttl = reg.get('auth.access_token_prolong_buffer_ttl', 30)  # seconds
+_prolong_buffer = {}  # token: token_info, not yet written prolongations
+_prolong_buffer_flushed = time()
+_prolong_buffer_lock = Lock()
+_access_tokens_l1 = _local_cache.LocalCache(reg.get('auth.access_tokens_l1_size', 0),
+                                            reg.get('auth.access_tokens_l1_ttl', 5))  # token: token_info
+_access_tokens_last_use_written = _local_cache.LocalCache(
+    reg.get('auth.access_token_last_use_cache_size', 10000) if _max_tokens_per_user else 0,
+    _access_token_last_use_resolution)  # token: True
+_access_token_users = _local_cache.LocalCache(reg.get('auth.access_token_users_cache_size', 0),
+                                              reg.get('auth.access_token_users_cache_ttl', 10))  # user.uid: user
+_missing_users = _local_cache.LocalCache(reg.get('auth.missing_users_cache_size', 0),
+                                         reg.get('auth.missing_users_cache_ttl', 30))  # 'field:value': True
+_users_bloom_enabled = reg.get('auth.users_bloom_filter_enabled', False)
+_users_bloom = _local_cache.BloomFilter(reg.get('auth.users_bloom_filter_capacity', 1000000) if _users_bloom_enabled
+                                        else 1)  # logins and nicknames of existing users
+_users_bloom_populated = False
+_users_bloom_lock = Lock()
+_invalidation_bus = None  # type: _driver.InvalidationBus
+_invalidation_handlers = [
+    ('auth.access_tokens', _access_tokens_l1.invalidate),
+    ('auth.users', _access_token_users.invalidate),
+    ('auth.missing_users', _missing_users.invalidate),
+    ('auth.missing_users', _users_bloom.add),
+]
 
 user_login_rule = validation.rule.Regex(msg_id='auth@login_str_rules',
                                         pattern='^[A-Za-z0-9][A-Za-z0-9.\-_@]{1,64}$')
@@ -37,15 +75,57 @@ user_nickname_rule = validation.rule.Regex(msg_id='auth@nickname_str_rules',
 def hash_password(secret: str) -> str:
     """Hash a password
     """
-    from werkzeug.security import generate_password_hash
-    return generate_password_hash(str(secret))
+    return _password.run(_password.hash_secret, str(secret))
 
 
 def verify_password(clear_text: str, hashed: str) -> bool:
     """Verify hashed password
     """
-    from werkzeug.security import check_password_hash
-    return check_password_hash(str(hashed), str(clear_text))
+    return _password.run(_password.check_secret, str(clear_text), str(hashed))
+
+
+def hash_password_async(secret: str) -> Awaitable[str]:
+    """Hash a password without blocking the event loop
+    """
+    return _password.run_async(_password.hash_secret, str(secret))
+
+
+def verify_password_async(clear_text: str, hashed: str) -> Awaitable[bool]:
+    """Verify hashed password without blocking the event loop
+    """
+    return _password.run_async(_password.check_secret, str(clear_text), str(hashed))
+
+
+def register_password_hasher(hasher: _driver.PasswordHasher):
+    """Register password hashing scheme
+    """
+    _password.register_hasher(hasher)
+
+
+def get_password_hasher(name: str = None) -> _driver.PasswordHasher:
+    """Get password hashing scheme
+
+    If name is not specified, the scheme selected by the 'auth.password_hasher' registry parameter is returned.
+    """
+    return _password.get_hasher(name)
+
+
+def password_needs_rehash(hashed: str) -> bool:
+    """Check if a password hash is made with outdated scheme or parameters
+    """
+    return _password.needs_rehash(str(hashed))
+
+
+def calibrate_password_hasher(name: str = None, target_time: float = 0.25) -> dict:
+    """Find hashing parameters which make hashing take about `target_time` seconds on the current host
+    """
+    return get_password_hasher(name).calibrate(target_time)
+
+
+def get_password_hasher_stats() -> dict:
+    """Get statistics of the password hashing pool
+    """
+    return _password.get_stats()
 
 
 def register_auth_driver(driver: _driver.Authentication):
@@ -106,6 +186,49 @@ def on_register_storage_driver(handler, priority: int = 0):
     events.listen('auth@register_storage_driver', handler, priority)
 
 
+def register_invalidation_bus(bus: _driver.InvalidationBus):
+    """Register cache invalidation bus
+    """
+    global _invalidation_bus
+
+    if _invalidation_bus and not isinstance(_invalidation_bus, _local_cache.LocalInvalidationBus):
+        raise _error.DriverRegistered('Invalidation bus is already registered')
+
+    if not isinstance(bus, _driver.InvalidationBus):
+        raise TypeError('Instance of {} expected'.format(type(_driver.InvalidationBus)))
+
+    _invalidation_bus = bus
+
+    for channel, handler in _invalidation_handlers:
+        bus.subscribe(channel, handler)
+
+
+def get_invalidation_bus() -> _driver.InvalidationBus:
+    """Get cache invalidation bus
+
+    In-process bus is used until another one is registered.
+    """
+    if not _invalidation_bus:
+        register_invalidation_bus(_local_cache.LocalInvalidationBus())
+
+    return _invalidation_bus
+
+
+def subscribe_invalidation(channel: str, handler):
+    """Subscribe to cache invalidation messages
+    """
+    _invalidation_handlers.append((channel, handler))
+
+    if _invalidation_bus:
+        _invalidation_bus.subscribe(channel, handler)
+
+
+def publish_invalidation(channel: str, keys: List[str]):
+    """Notify all processes about invalidated cache keys
+    """
+    get_invalidation_bus().publish(channel, keys)
+
+
 def get_storage_driver() -> _driver.Storage:
     """Get driver instance
     """
@@ -122,55 +245,98 @@ def create_user(login: str, password: str = None) -> _model.AbstractUser:
     if not login:
         raise _error.UserCreateError(lang.t('auth@login_str_rules'))
 
-    # Various checks
-    if login not in (_model.ANONYMOUS_USER_LOGIN, _model.SYSTEM_USER_LOGIN):
-        try:
-            # Check user existence
-            get_user(login)
-            raise _error.UserExists()
+    # Anonymous and system users are never stored
+    if login in (_model.ANONYMOUS_USER_LOGIN, _model.SYSTEM_USER_LOGIN):
+        user = get_storage_driver().create_user(login, password)
+        user.status = USER_STATUS_ACTIVE
+        user.roles = [get_role('anonymous')]
 
-        except _error.UserNotFound:
-            # Check user login
-            try:
-                user_login_rule.validate(login)
-            except validation.error.RuleError as e:
-                raise _error.UserCreateError(e)
+        return user
 
-    # Create user
-    user = get_storage_driver().create_user(login, password)
+    # Check user login
+    try:
+        user_login_rule.validate(login)
+    except validation.error.RuleError as e:
+        raise _error.UserCreateError(e)
 
-    # Attach roles
-    if login not in (_model.ANONYMOUS_USER_LOGIN, _model.SYSTEM_USER_LOGIN):
-        # Set user's status
-        user.status = get_new_user_status()
+    # Storage driver checks user existence while inserting, and the user is stored at once even inside a batch
+    with _batch.suspend():
+        user = get_storage_driver().insert_user(login, password, get_new_user_status(),
+                                                [get_role(r) for r in get_new_user_roles()],
+                                                not is_sign_up_confirmation_required())
 
-        # Generate confirmation hash
-        if is_sign_up_confirmation_required():
-            user.is_confirmed = False
+    events.fire('auth@user_create', user=user)
 
-        user.roles = [get_role(r) for r in get_new_user_roles()]
-        user.save()
+    return user
 
-        events.fire('auth@user_create', user=user)
 
-    else:
-        user.status = USER_STATUS_ACTIVE
-        user.roles = [get_role('anonymous')]
+def insert_users(items: List[dict]) -> List[Union[_model.AbstractUser, Exception]]:
+    """Create several users with a single storage write
 
-    return user
+    Each item contains 'login', 'password_hash' and optionally 'status', 'roles', 'is_confirmed' and other fields.
+    Returns created users in order of items, items which could not be inserted are represented by exceptions.
+    """
+    r = [None] * len(items)  # type: List[Union[_model.AbstractUser, Exception]]
+
+    valid = []
+    for i, item in enumerate(items):
+        try:
+            user_login_rule.validate(item.get('login'))
+            valid.append(i)
+        except validation.error.RuleError as e:
+            r[i] = _error.UserCreateError(e)
+
+    if valid:
+        with _batch.suspend():
+            inserted = get_storage_driver().insert_users([items[i] for i in valid])
+
+        for i, user in zip(valid, inserted):
+            r[i] = user
+            if not isinstance(user, Exception):
+                events.fire('auth@user_create', user=user)
 
+    return r
 
-def get_user(login: str = None, nickname: str = None, uid: str = None, access_token: str = None) -> _model.AbstractUser:
+
+def get_user(login: str = None, nickname: str = None, uid: str = None, access_token: str = None,
+             fields: List[str] = None) -> _model.AbstractUser:
     """Get user
+
+    If `fields` is given, a read-only partial user having only these fields and UID loaded is returned.
     """
-    # Convert access token to user UID
+    if fields:
+        return _get_partial_user(login, nickname, uid, access_token, fields)
+
+    user = None
+
+    # Convert access token to user UID. Revoked tokens are rejected here, so cached users are safe to return.
     if access_token:
-        return get_user(uid=get_access_token_info(access_token)['user_uid'])
+        login = nickname = None
+        uid = get_access_token_info(access_token)['user_uid']
+        user = _access_token_users.get(uid)
+
+    # Look into the identity map of the current unit of work
+    i_map = _identity_map.get_current()
+    if not user and i_map:
+        user = i_map.get('user', uid=uid, login=login, nickname=nickname)
 
     # Retrieve user from storage driver
-    user = get_storage_driver().get_user(login, nickname, uid)
     if not user:
-        raise _error.UserNotFound()
+        missing_key = _get_missing_user_key(login, nickname, uid)
+        if missing_key and (_missing_users.get(missing_key) or not _users_bloom_may_contain(missing_key)):
+            raise _error.UserNotFound()
+
+        user = get_storage_driver().get_user(login, nickname, uid)
+        if not user:
+            if missing_key:
+                _missing_users.put(missing_key, True)
+            raise _error.UserNotFound()
+
+        if access_token:
+            _access_token_users.put(uid, user)
+
+    if i_map and user not in i_map:
+        i_map.add(user)
 
     # Sign out non-active users
     if user == get_current_user() and user.status != USER_STATUS_ACTIVE:
@@ -179,6 +345,101 @@ def get_user(login: str = None, nickname: str = None, uid: str = None, access_to
     return user
 
 
+def _get_partial_user(login: str, nickname: str, uid: str, access_token: str,
+                      fields: List[str]) -> _model.PartialUser:
+    """Get a partially loaded user
+
+    Partial users are never cached, but they are cheaply made from fully loaded users which are already at hand.
+    """
+    if access_token:
+        login = nickname = None
+        uid = get_access_token_info(access_token)['user_uid']
+
+    user = _access_token_users.get(uid) if access_token else None
+
+    i_map = _identity_map.get_current()
+    if not user and i_map:
+        user = i_map.get('user', uid=uid, login=login, nickname=nickname)
+
+    if user:
+        return _model.PartialUser.from_user(user, fields)
+
+    missing_key = _get_missing_user_key(login, nickname, uid)
+    if missing_key and (_missing_users.get(missing_key) or not _users_bloom_may_contain(missing_key)):
+        raise _error.UserNotFound()
+
+    user = get_storage_driver().get_partial_user(login, nickname, uid, fields)
+    if not user:
+        if missing_key:
+            _missing_users.put(missing_key, True)
+        raise _error.UserNotFound()
+
+    return user
+
+
+def get_users(uids: List[str] = None, logins: List[str] = None,
+              nicknames: List[str] = None) -> List[_model.AbstractUser]:
+    """Get several users at once
+
+    Users are returned in order of arguments, non-existent ones are skipped.
+    """
+    if not (uids or logins or nicknames):
+        return []
+
+    return list(_map_identities(iter(get_storage_driver().get_users(uids, logins, nicknames))))
+
+
+def _get_missing_user_key(login: str = None, nickname: str = None, uid: str = None) -> Optional[str]:
+    """Get the key of a lookup in the negative lookups cache
+
+    Only lookups by a single field are cached.
+    """
+    fields = [(k, v) for k, v in (('login', login), ('nickname', nickname), ('uid', uid)) if v]
+
+    return '{}:{}'.format(*fields[0]) if len(fields) == 1 else None
+
+
+def get_user_lookup_keys(user: _model.AbstractUser) -> List[str]:
+    """Get keys which should be dropped from negative lookups caches after the user is created or modified
+    """
+    return ['{}:{}'.format(f, user.get_field(f)) for f in ('login', 'nickname', 'uid') if user.get_field(f)]
+
+
+def _users_bloom_may_contain(key: str) -> bool:
+    """Check if the user with given login or nickname may exist
+
+    Until the filter is built any user may exist.
+    """
+    if not (_users_bloom_enabled and _users_bloom_populated) or key.startswith('uid:'):
+        return True
+
+    return key in _users_bloom
+
+
+def build_users_bloom_filter():
+    """Build the filter of logins and nicknames of existing users
+
+    It is a full scan of users, so it is done out of requests, by cron. Then the filter receives updates through the
+    invalidation bus, so it must be enabled only along with a bus which delivers messages to all processes.
+    """
+    global _users_bloom_populated
+
+    if not _users_bloom_enabled or _users_bloom_populated:
+        return
+
+    # Concurrent build is already in progress
+    if not _users_bloom_lock.acquire(False):
+        return
+
+    try:
+        # Users created during the scan are added through the invalidation bus as well
+        for user in get_storage_driver().find_partial_users(fields=['login', 'nickname']):
+            _users_bloom.add(get_user_lookup_keys(user))
+        _users_bloom_populated = True
+    finally:
+        _users_bloom_lock.release()
+
+
 def get_admin_users(sort: List[Tuple[str, int]] = None, active_only: bool = True) -> Iterator[_model.AbstractUser]:
     """Get admin users
     """
@@ -235,14 +496,92 @@ def create_role(name: str, description: str = ''):
 def get_role(name: str = None, uid: str = None) -> _model.AbstractRole:
     """Get a role
     """
-    return get_storage_driver().get_role(name, uid)
+    i_map = _identity_map.get_current()
+    if not i_map:
+        return get_storage_driver().get_role(name, uid)
+
+    role = i_map.get('role', uid=uid, name=name)
+    if not role:
+        role = get_storage_driver().get_role(name, uid)
+        i_map.add(role)
+
+    return role
+
+
+@contextmanager
+def identity_map():
+    """Share users and roles instances within a unit of work
+
+    Nested units of work share the identity map of the outermost one.
+    """
+    started = _identity_map.begin()
+
+    try:
+        yield
+    finally:
+        if started:
+            _identity_map.end()
+
+
+@contextmanager
+def batch():
+    """Save users and roles with a single bulk write at the end of a unit of work
+
+    Calls of save() are postponed, then pre-save events are fired, collected entities are stored by the storage
+    driver and post-save events are fired. Raises error.BatchSaveError if some of entities have not been saved, others
+    are saved anyway. Nothing is saved if the unit of work raises an exception. Nested batches join the outermost one.
+New users are created with create_user() and insert_users() at once, not postponed.
+    """
+    started = _batch.begin()
+
+    try:
+        yield
+    except BaseException:
+        if started:
+            _batch.end(False)
+        raise
+    else:
+        if started:
+            _batch.end()
+
+
+def _map_identities(entities: Iterator[_model.AuthEntity]) -> Iterator[_model.AuthEntity]:
+    """Replace entities with their instances from the identity map of the current unit of work
+    """
+    i_map = _identity_map.get_current()
+    if not i_map:
+        return entities
+
+    def mapper():
+        for entity in entities:
+            mapped = i_map.get(entity.auth_entity_type, uid=entity.uid)
+            if not mapped:
+                i_map.add(entity)
+            yield mapped or entity
+
+    return mapper()
 
 
 def sign_in(auth_driver_name: str = None, data: dict = None) -> _model.AbstractUser:
     """Authenticate user
     """
+    # Reject throttled attempts before any storage lookup or password verification
+    throttle_keys = _throttle.get_keys(data)
+    _throttle.check(throttle_keys)
+
     # Get user from driver
-    user = get_auth_driver(auth_driver_name).sign_in(data)
+    try:
+        user = get_auth_driver(auth_driver_name).sign_in(data)
+    except (_error.AuthenticationError, _error.UserNotFound):
+        _throttle.register_failure(throttle_keys)
+        raise
+
+    _throttle.register_success(throttle_keys)
+
+    # Upgrade outdated password hash, new one will be stored along with statistics below
+    password = (data or {}).get('password')
+    if password and user.password and password_needs_rehash(user.password) and verify_password(password, user.password):
+        user.password = password
 
     if user.status != USER_STATUS_ACTIVE:
         raise _error.UserNotActive()
@@ -266,16 +605,194 @@ def sign_in(auth_driver_name: str = None, data: dict = None) -> _model.AbstractU
 def get_access_token_info(token: str) -> dict:
     """Get access token's metadata
     """
+    token_info = _access_tokens_l1.get(token)
+    if token_info:
+        _touch_access_token(token, token_info)
+        return dict(token_info)
+
+    # Signed tokens are verified locally, the cache is used only to check if the token was not revoked
+    if _token.is_signed(token):
+        user_uid, created, expires = _token.verify(token)
+        if _revoked_access_tokens.has(_token.get_signature(token)):
+            raise _error.InvalidAccessToken('Access token has been revoked')
+
+        token_info = {
+            'user_uid': user_uid,
+            'ttl': _access_token_ttl,
+            'created': datetime.fromtimestamp(created),
+            'expires': datetime.fromtimestamp(expires),
+        }
+
+    else:
+        try:
+            token_info = _token.unpack_info(_access_tokens.get(token))
+        except (cache.error.KeyNotExist, ValueError):
+            # Record may be written by an incompatible version during a rollout or a rollback
+            raise _error.InvalidAccessToken('Invalid access token')
+
+    _access_tokens_l1.put(token, token_info, token_info['expires'].timestamp() - time())
+    _touch_access_token(token, token_info)
+
+    return dict(token_info)
+
+
+def _touch_access_token(token: str, token_info: dict):
+    """Remember token's last use time
+
+    Last use time is needed only to evict least recently used tokens, and it is written not more often than once per
+    auth.access_token_last_use_resolution seconds per process.
+    """
+    if not _max_tokens_per_user or _access_tokens_last_use_written.get(token):
+        return
+
+    _access_tokens_last_use.put_hash_item(token_info['user_uid'], token, int(time()), _access_token_ttl)
+    _access_tokens_last_use_written.put(token, True)
+
+
+def get_access_tokens_info(tokens: Iterable[str]) -> Dict[str, Optional[dict]]:
+    """Get metadata of several access tokens at once
+
+    Metadata of invalid tokens is None.
+    """
+    r = {}
+    for token in tokens:
+        if token in r:
+            continue
+
+        try:
+            r[token] = get_access_token_info(token)
+        except _error.InvalidAccessToken:
+            r[token] = None
+
+    return r
+
+
+def get_users_by_access_tokens(tokens: Iterable[str]) -> Dict[str, Optional[_model.AbstractUser]]:
+    """Get users of several access tokens at once
+
+    Users of invalid tokens and non-existent users are None.
+    """
+    tokens_info = get_access_tokens_info(tokens)
+
+    # Look into the cache first, then fetch all missing users by a single query
+    users = {}
+    missing = []
+    for user_uid in {t_info['user_uid'] for t_info in tokens_info.values() if t_info}:
+        user = _access_token_users.get(user_uid)
+        if user:
+            users[user_uid] = user
+        else:
+            missing.append(user_uid)
+
+    for user in get_users(uids=missing):
+        users[user.uid] = user
+        _access_token_users.put(user.uid, user)
+
+    return {token: users.get(t_info['user_uid']) if t_info else None for token, t_info in tokens_info.items()}
+
+
+def get_access_tokens_cache_stats() -> dict:
+    """Get statistics of the in-process access tokens cache
+    """
+    return _access_tokens_l1.get_stats()
+
+
+def _put_access_token_info(token: str, token_info: dict, ttl: int):
+    """Store token's metadata
+    """
+    _access_tokens.put(token, _token.pack_info(token_info) if _access_token_compact_records else token_info, ttl)
+
+
+def _add_user_access_token(user_uid: str, token: str, expires: int):
+    """Add a token to the user's tokens index
+    """
+    # Each token expires not later than TTL seconds after the last write, so does the whole index
+    _user_access_tokens.put_hash_item(user_uid, token, expires, _access_token_ttl)
+
+
+def _remove_user_access_token(user_uid: str, token: str):
+    """Remove a token from the user's tokens index
+    """
+    _user_access_tokens.rm_hash_item(user_uid, token)
+
+    if _max_tokens_per_user:
+        _access_tokens_last_use.rm_hash_item(user_uid, token)
+
+
+def _migrate_user_access_tokens(user_uid: str):
+    """Move user's tokens issued by previous versions into the user's tokens index
+    """
     try:
-        return _access_tokens.get(token)
+        tokens = _legacy_user_access_tokens.rm(user_uid)  # type: List[str]
+    except cache.error.KeyNotExist:
+        return
 
+    for token in tokens or ():
+        try:
+            token_info = _token.unpack_info(_access_tokens.get(token))
+        except cache.error.KeyNotExist:
+            continue  # Expired or revoked
+        except ValueError:
+            continue  # Unreadable, so it cannot be used anyway
+
+        _add_user_access_token(user_uid, token, int(token_info['expires'].timestamp()))
+
+
+def _get_user_access_tokens_index(user_uid: str) -> Dict[str, int]:
+    """Get user's valid tokens along with their expiration timestamps
+    """
+    _migrate_user_access_tokens(user_uid)
+
+    try:
+        index = _user_access_tokens.get_hash(user_uid)  # type: Dict[str, int]
     except cache.error.KeyNotExist:
-        raise _error.InvalidAccessToken('Invalid access token')
+        return {}
+
+    # Drop expired tokens from the index on the way
+    now = time()
+    for token, expires in list(index.items()):
+        if expires <= now:
+            _remove_user_access_token(user_uid, token)
+            del index[token]
+
+    return index
+
+
+def _evict_user_access_tokens(user_uid: str, keep: int):
+    """Revoke user's least recently used tokens, leaving no more than `keep` ones
+    """
+    index = _get_user_access_tokens_index(user_uid)
+    if len(index) <= keep:
+        return
+
+    try:
+        last_use = _access_tokens_last_use.get_hash(user_uid)  # type: Dict[str, int]
+    except cache.error.KeyNotExist:
+        last_use = {}
+
+    # Token which has never been used is considered used at its issue time
+    lru = sorted(index, key=lambda t: last_use.get(t, index[t] - _access_token_ttl))
+    evicted = {token: index[token] for token in lru[:len(index) - keep]}
+
+    _drop_access_tokens(evicted)
+    for token in evicted:
+        _remove_user_access_token(user_uid, token)
 
 
 def generate_access_token(user: _model.AbstractUser) -> str:
     """Generate a new access token
     """
+    # Make room for the new token
+    if _max_tokens_per_user:
+        _evict_user_access_tokens(user.uid, _max_tokens_per_user - 1)
+
+    if _access_token_type == 'signed':
+        now = int(time())
+        token = _token.sign(user.uid, now, now + _access_token_ttl)
+        _add_user_access_token(user.uid, token, now + _access_token_ttl)
+
+        return token
+
     while True:
         token = util.random_str(32)
 
@@ -288,14 +805,8 @@ def generate_access_token(user: _model.AbstractUser) -> str:
                 'expires': now + timedelta(seconds=_access_token_ttl),
             }
 
-            _access_tokens.put(token, t_info, _access_token_ttl)
-
-            try:
-                user_tokens = _user_access_tokens.get(user.uid)  # type: list
-                user_tokens.append(token)
-                _user_access_tokens.put(user.uid, user_tokens)
-            except cache.error.KeyNotExist:
-                _user_access_tokens.put(user.uid, [token])
+            _put_access_token_info(token, t_info, _access_token_ttl)
+            _add_user_access_token(user.uid, token, int(time()) + _access_token_ttl)
 
             return token
 
@@ -303,40 +814,150 @@ def generate_access_token(user: _model.AbstractUser) -> str:
 def get_user_access_tokens(user: _model.AbstractUser) -> List[str]:
     """Get user's access tokens
     """
-    try:
-        return _user_access_tokens.get(user.uid)
-    except cache.error.KeyNotExist:
-        return []
+    return list(_get_user_access_tokens_index(user.uid))
+
+
+def _drop_access_tokens(tokens: Dict[str, int]):
+    """Make tokens invalid without touching users' indexes
+
+    Tokens' expiration timestamps are expected as values, so no lookups are needed.
+    """
+    now = time()
+
+    # Buffered prolongations must not resurrect revoked tokens
+    with _prolong_buffer_lock:
+        for token in tokens:
+            _prolong_buffer.pop(token, None)
+
+    for token, expires in tokens.items():
+        if _token.is_signed(token):
+            # Signed token remains in the revocation list until its expiration
+            if expires > now:
+                _revoked_access_tokens.put(_token.get_signature(token), True, max(int(expires - now), 1))
+        else:
+            try:
+                _access_tokens.rm(token)
+            except cache.error.KeyNotExist:
+                pass
+
+    if tokens:
+        _access_tokens_l1.invalidate(tokens)
+        publish_invalidation('auth.access_tokens', list(tokens))
 
 
 def revoke_access_token(token: str):
     """Revoke an access token
     """
-    if not token or not _access_tokens.has(token):
+    if not token:
         raise _error.InvalidAccessToken('Invalid access token')
 
-    user_uid = get_access_token_info(token)['user_uid']
-    user_tokens = _user_access_tokens.get(user_uid)  # type: List[str]
-    user_tokens.remove(token)
-    _user_access_tokens.put(user_uid, user_tokens)
+    token_info = get_access_token_info(token)
+    _drop_access_tokens({token: token_info['expires'].timestamp()})
+    _remove_user_access_token(token_info['user_uid'], token)
+
+
+def revoke_access_tokens(tokens: Iterable[str]):
+    """Revoke several access tokens at once
 
-    _access_tokens.rm(token)
+    Invalid and already revoked tokens are skipped.
+    """
+    to_drop = {}
+    to_unindex = []
+    for token, token_info in get_access_tokens_info(tokens).items():
+        if not token_info:
+            continue
+
+        to_drop[token] = token_info['expires'].timestamp()
+        to_unindex.append((token_info['user_uid'], token))
+
+    _drop_access_tokens(to_drop)
+    for user_uid, token in to_unindex:
+        _remove_user_access_token(user_uid, token)
 
 
 def revoke_user_access_tokens(user: _model.AbstractUser):
     """Revoke all user access tokens
     """
-    # Revoke user access tokens
-    for token in _user_access_tokens.rm(user.uid):
-        revoke_access_token(token)
+    _migrate_user_access_tokens(user.uid)
+
+    try:
+        index = _user_access_tokens.get_hash(user.uid)  # type: Dict[str, int]
+    except cache.error.KeyNotExist:
+        return
 
+    # User's index already holds expiration timestamps, so tokens can be dropped without lookups
+    _drop_access_tokens(index)
+
+    for pool in (_user_access_tokens, _access_tokens_last_use):
+        try:
+            pool.rm(user.uid)
+        except cache.error.KeyNotExist:
+            pass
 
-def prolong_access_token(token: str):
+
+def prolong_access_token(token: str) -> str:
     """Prolong an access token
+
+    Signed tokens cannot be modified, so a new token with extended expiration time is issued for them, while the
+    original one remains valid until its own expiration. The token which should be used further is returned.
     """
     token_info = get_access_token_info(token)
-    token_info['expires'] = datetime.now() + timedelta(seconds=_access_token_ttl),
-    _access_tokens.put(token, token_info, _access_token_ttl)
+    now = time()
+
+    # Token has been issued or prolonged recently enough, so there is nothing to write yet
+    prolonged = token_info['expires'].timestamp() - _access_token_ttl
+    if now - prolonged < _access_token_ttl * _access_token_prolong_threshold:
+        return token
+
+    expires = int(now) + _access_token_ttl
+
+    if _token.is_signed(token):
+        new_token = _token.sign(token_info['user_uid'], int(token_info['created'].timestamp()), expires)
+        _add_user_access_token(token_info['user_uid'], new_token, expires)
+
+        return new_token
+
+    token_info = dict(token_info, expires=datetime.fromtimestamp(expires))
+
+    if not _access_token_prolong_buffer_size:
+        _put_access_token_info(token, token_info, _access_token_ttl)
+        _access_tokens_l1.invalidate((token,))
+        _add_user_access_token(token_info['user_uid'], token, expires)
+
+        return token
+
+    with _prolong_buffer_lock:
+        _prolong_buffer[token] = token_info
+        need_flush = len(_prolong_buffer) >= _access_token_prolong_buffer_size or \
+                     now - _prolong_buffer_flushed >= _access_token_prolong_buffer_ttl
+
+    if need_flush:
+        flush_access_tokens_prolongations()
+
+    return token
+
+
+def flush_access_tokens_prolongations():
+    """Write buffered access tokens prolongations
+    """
+    global _prolong_buffer_flushed
+
+    with _prolong_buffer_lock:
+        buffer = dict(_prolong_buffer)
+        _prolong_buffer.clear()
+        _prolong_buffer_flushed = time()
+
+    for token, token_info in buffer.items():
+        # Token could be revoked by another process meanwhile
+        if not _access_tokens.has(token):
+            continue
+
+        expires = int(token_info['expires'].timestamp())
+        ttl = expires - int(time())
+        if ttl > 0:
+            _put_access_token_info(token, token_info, ttl)
+            _access_tokens_l1.invalidate((token,))
+            _add_user_access_token(token_info['user_uid'], token, expires)
 
 
 def sign_out(user: _model.AbstractUser):
@@ -439,25 +1060,48 @@ def get_new_user_roles() -> list:
 
 
 def find_users(query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 0,
-               skip: int = 0) -> Iterator[_model.AbstractUser]:
+               skip: int = 0, fields: List[str] = None) -> Iterator[_model.AbstractUser]:
     """Find users
+
+    If `fields` is given, read-only partial users having only these fields and UID loaded are returned.
     """
-    return get_storage_driver().find_users(query, sort, limit, skip)
+    if fields:
+        return get_storage_driver().find_partial_users(query, sort, limit, skip, fields)
+
+    return _map_identities(get_storage_driver().find_users(query, sort, limit, skip))
 
 
 def find_user(query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 0,
-              skip: int = 0) -> Optional[_model.AbstractUser]:
+              skip: int = 0, fields: List[str] = None) -> Optional[_model.AbstractUser]:
     try:
-        return next(find_users(query, sort, limit, skip))
+        return next(find_users(query, sort, limit, skip, fields))
     except StopIteration:
         return None
 
 
+def find_users_page(query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 100,
+                    cursor: str = None, fields: List[str] = None) -> Tuple[List[_model.AbstractUser], Optional[str]]:
+    """Find a page of users using keyset pagination
+
+    Returns users and the cursor of the next page, which is None for the last page. If `fields` is given, read-only
+    partial users having only these fields, UID and sort keys loaded are returned.
+    """
+    if fields:
+        fields = list(fields) + [f for f, _ in _pagination.normalize_sort(sort) if f not in fields]
+
+        return _pagination.find_page(lambda q, s, l: get_storage_driver().find_partial_users(q, s, l, 0, fields),
+                                     query, sort, limit, cursor)
+
+    users, next_cursor = get_storage_driver().find_users_page(query, sort, limit, cursor)
+
+    return list(_map_identities(iter(users))), next_cursor
+
+
 def find_roles(query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 0,
                skip: int = 0) -> Iterator[_model.AbstractRole]:
     """Get roles iterable
     """
-    return get_storage_driver().find_roles(query, sort, limit, skip)
+    return _map_identities(get_storage_driver().find_roles(query, sort, limit, skip))
 
 
 def find_role(query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 0,
@@ -468,16 +1112,52 @@ def find_role(query: query.Query = None, sort: List[Tuple[str, int]] = None, lim
         return None
 
 
+def find_roles_page(query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 100,
+                    cursor: str = None) -> Tuple[List[_model.AbstractRole], Optional[str]]:
+    """Find a page of roles using keyset pagination
+
+    Returns roles and the cursor of the next page, which is None for the last page.
+    """
+    roles, next_cursor = get_storage_driver().find_roles_page(query, sort, limit, cursor)
+
+    return list(_map_identities(iter(roles))), next_cursor
+
+
 def count_users(query: query.Query = None) -> int:
     """Count users
+
+    Queries matching registered user counters are answered by the counters.
     """
-    return get_storage_driver().count_users(query)
+    counter = _counter.find(query)
+
+    return _counter.get(counter) if counter else get_storage_driver().count_users(query)
 
 
 def count_roles(query: query.Query = None) -> int:
     """Count roles
     """
-    return get_storage_driver().count_roles(query)
+    return get_storage_driver().count_roles(query) if query else _counter.count_roles()
+
+
+def register_user_counter(name: str, conditions: dict):
+    """Register a maintained counter of users matching conditions
+
+    Conditions map field names to values, e.g. {'status': 'active'} or {'roles': get_role('admin')}. Counter is updated
+    on users' changes, and count_users() with a query of same conditions returns its value instead of counting users.
+    """
+    _counter.register(name, conditions)
+
+
+def get_user_count(name: str) -> int:
+    """Get value of a user counter
+    """
+    return _counter.get(name)
+
+
+def reconcile_user_counters():
+    """Recount user counters by the storage driver
+    """
+    _counter.reconcile()
 
 
 def is_sign_up_enabled() -> bool:
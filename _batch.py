@@ -0,0 +1,130 @@
+"""PytSite Auth Plugin Batch Save
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from typing import Dict, List, Optional, Tuple
+from contextlib import contextmanager
+from pytsite import threading, events
+from . import _model, _error, _counter
+
+_batches = {}  # type: Dict[int, Batch]  # Per thread
+
+
+class Batch:
+    """Collects entities being saved to store them with a single bulk write
+    """
+
+    def __init__(self):
+        self._entities = []  # type: List[_model.AuthEntity]
+        self._ids = set()
+
+    def add(self, entity: _model.AuthEntity):
+        """Add an entity, each instance is saved once regardless of how many times it has been added
+        """
+        if id(entity) not in self._ids:
+            self._ids.add(id(entity))
+            self._entities.append(entity)
+
+    def __len__(self) -> int:
+        return len(self._entities)
+
+    @staticmethod
+    def _fire(entity: _model.AuthEntity, event: str):
+        e_type = entity.auth_entity_type
+        events.fire('auth@{}_{}'.format(e_type, event), **{e_type: entity})
+
+    def flush(self) -> List[Tuple[_model.AuthEntity, Exception]]:
+        """Save collected entities
+
+        Returns failed entities along with their errors, failure of an entity does not prevent saving others.
+        """
+        entities, failed = [], []
+        for entity in self._entities:
+            try:
+                self._fire(entity, 'pre_save')
+                entities.append(entity)
+            except Exception as e:
+                failed.append((entity, e))
+
+        self._entities, self._ids = [], set()
+        if entities:
+            failed += self._save(entities)
+
+        for entity, _ in failed:
+            if isinstance(entity, _model.AbstractUser):
+                _counter.on_user_save_failed(entity)
+
+        return failed
+
+    def _save(self, entities: List[_model.AuthEntity]) -> List[Tuple[_model.AuthEntity, Exception]]:
+        """Store entities and fire post-save events
+        """
+        from . import _api
+
+        failed = []
+
+        errors = _api.get_storage_driver().save_entities(entities)
+
+        for entity, error in zip(entities, errors):
+            if error:
+                failed.append((entity, error))
+                continue
+
+            try:
+                self._fire(entity, 'save')
+            except Exception as e:
+                failed.append((entity, e))
+
+        return failed
+
+
+def begin() -> bool:
+    """Start a batch in the current thread
+
+    Returns False if the thread is already inside a batch.
+    """
+    tid = threading.get_id()
+    if tid in _batches:
+        return False
+
+    _batches[tid] = Batch()
+
+    return True
+
+
+def end(commit: bool = True):
+    """Finish the batch of the current thread, saving collected entities
+
+    Raises error.BatchSaveError if any of entities has not been saved.
+    """
+    batch = _batches.pop(threading.get_id(), None)
+    if not (batch and commit):
+        return
+
+    failed = batch.flush()
+    if failed:
+        raise _error.BatchSaveError(failed)
+
+
+@contextmanager
+def suspend():
+    """Save entities immediately within the block even if the current thread is inside a batch
+
+    Used by operations which have to know the result of saving at once, like creating users.
+    """
+    tid = threading.get_id()
+    batch = _batches.pop(tid, None)
+
+    try:
+        yield
+    finally:
+        if batch is not None:
+            _batches[tid] = batch
+
+
+def get_current() -> Optional[Batch]:
+    """Get the batch of the current thread
+    """
+    return _batches.get(threading.get_id())
@@ -4,9 +4,37 @@ __author__ = 'Oleksandr Shepetko'
 __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
+import sys
+import csv
+import json
+from os import path, replace
+from typing import Any, Iterator, List, Optional, Tuple, Union
+from datetime import datetime
 from getpass import getpass
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 from pytsite import console, lang
-from . import _api, _error
+from plugins import query
+from . import _api, _error, _model
+
+# Fields which can be imported along with login, password, roles and status
+_IMPORT_FIELDS = ('nickname', 'first_name', 'middle_name', 'last_name', 'position', 'timezone', 'gender', 'phone',
+                  'country', 'postal_code', 'province', 'city', 'district', 'street', 'building', 'apt_number',
+                  'is_confirmed', 'is_public')
+
+_EXPORT_FIELDS = 'uid,login,nickname,status,created'
+
+_QUERY_OPS = {
+    '$eq': query.Eq,
+    '$ne': query.Ne,
+    '$gt': query.Gt,
+    '$gte': query.Gte,
+    '$lt': query.Lt,
+    '$lte': query.Lte,
+    '$in': query.In,
+    '$nin': query.Nin,
+}
 
 
 class UserAdd(console.Command):
@@ -214,3 +242,314 @@ class UserDel(console.Command):
 
         except _error.Error as e:
             raise console.error.CommandExecutionError(e)
+
+
+class Import(console.Command):
+    """auth:import Console Command
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Str('format'))
+        self.define_option(console.option.Str('roles'))
+        self.define_option(console.option.Str('status'))
+        self.define_option(console.option.Str('checkpoint'))
+        self.define_option(console.option.Int('batch', default=500))
+        self.define_option(console.option.Int('workers', default=4))
+        self.define_option(console.option.Bool('prehashed'))
+
+    @property
+    def name(self) -> str:
+        """Get command's name
+        """
+        return 'auth:import'
+
+    @property
+    def description(self) -> str:
+        """Get command's description
+        """
+        return 'auth@import_console_command_description'
+
+    @staticmethod
+    def _read(stream, fmt: str) -> Iterator[Tuple[int, Union[dict, str]]]:
+        """Read records along with numbers of lines they start at
+
+        JSONL lines are yielded unparsed, so a malformed one fails only its own record.
+        """
+        if fmt == 'csv':
+            reader = csv.DictReader(stream)
+            reader.fieldnames  # Read the header
+
+            # Quoted values may span several lines, so a record starts right after the previous one ends
+            last_line = reader.line_num
+            for record in reader:
+                yield last_line + 1, record
+                last_line = reader.line_num
+        else:
+            for line_num, line in enumerate(stream, 1):
+                if line.strip():
+                    yield line_num, line
+
+    @staticmethod
+    def _to_bool(value) -> bool:
+        return value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes')
+
+    def _get_roles(self, value, roles_cache: dict) -> list:
+        """Resolve roles, each role is fetched only once
+        """
+        names = value if isinstance(value, list) else [r.strip() for r in str(value).split(',') if r.strip()]
+        for name in names:
+            if name not in roles_cache:
+                roles_cache[name] = _api.get_role(name)
+
+        return [roles_cache[name] for name in names]
+
+    def _import_batch(self, records: List[Tuple[int, Tuple[int, Union[dict, str]]]], pool: ThreadPoolExecutor, roles_cache: dict,
+                      default_roles: list) -> Tuple[int, int, int]:
+        """Import a batch of records
+
+        Returns numbers of created, skipped and failed users.
+        """
+        items = []
+        passwords = []
+        failed = 0
+        logins = set()
+        for _, (line_num, record) in records:
+            try:
+                if isinstance(record, str):
+                    record = json.loads(record)
+                if not isinstance(record, dict):
+                    raise ValueError('Record must be an object')
+
+                login = str(record.get('login') or '').strip()
+                _api.user_login_rule.validate(login)
+                if login in logins:
+                    raise _error.UserExists()
+                logins.add(login)
+
+                item = {f: record[f] for f in _IMPORT_FIELDS if record.get(f) not in (None, '')}
+                for f in ('is_confirmed', 'is_public'):
+                    if f in item:
+                        item[f] = self._to_bool(item[f])
+                item['login'] = login
+                item['status'] = record.get('status') or self.opt('status') or _api.get_new_user_status()
+                item['roles'] = self._get_roles(record['roles'], roles_cache) if record.get('roles') else default_roles
+                items.append(item)
+                passwords.append(record.get('password') or '')
+
+            except Exception as e:
+                console.print_warning(lang.t('auth@import_record_failed', {'line': line_num, 'error': e}))
+                failed += 1
+
+        # Skip existing users, all of them are checked with a single query
+        existing = {u.login for u in _api.get_users(logins=[i['login'] for i in items])}
+        if existing:
+            passwords = [p for i, p in zip(items, passwords) if i['login'] not in existing]
+            items = [i for i in items if i['login'] not in existing]
+
+        # Hash passwords in parallel
+        if self.opt('prehashed'):
+            hashes = passwords
+        else:
+            hashes = pool.map(lambda p: _api.hash_password(p) if p else '', passwords)
+        for item, password_hash in zip(items, hashes):
+            item['password_hash'] = password_hash
+
+        created = 0
+        for item, result in zip(items, _api.insert_users(items) if items else []):
+            if isinstance(result, _error.UserExists):
+                existing.add(item['login'])
+            elif isinstance(result, Exception):
+                console.print_warning(lang.t('auth@import_user_failed', {'login': item['login'], 'error': result}))
+                failed += 1
+            else:
+                created += 1
+
+        return created, len(existing), failed
+
+    def exec(self):
+        """Execute the command
+        """
+        src = self.arg(0) or '-'
+        fmt = self.opt('format') or ('csv' if src.endswith('.csv') else 'jsonl')
+        if fmt not in ('jsonl', 'csv'):
+            raise console.error.CommandExecutionError(lang.t('auth@import_export_invalid_format', {'format': fmt}))
+
+        batch_size = max(self.opt('batch'), 1)
+        checkpoint = self.opt('checkpoint')
+
+        # Number of already processed records
+        offset = 0
+        if checkpoint and path.exists(checkpoint):
+            with open(checkpoint) as f:
+                offset = int(f.read().strip() or 0)
+
+        try:
+            roles_cache = {}
+            default_roles = self._get_roles(self.opt('roles') or _api.get_new_user_roles(), roles_cache)
+        except _error.RoleNotFound as e:
+            raise console.error.CommandExecutionError(e)
+
+        stream = sys.stdin if src == '-' else open(src, newline='', encoding='utf-8')
+        totals = [0, 0, 0]
+        started = time()
+        try:
+            records = islice(enumerate(self._read(stream, fmt), 1), offset, None)
+            with ThreadPoolExecutor(max(self.opt('workers'), 1)) as pool:
+                while True:
+                    batch = list(islice(records, batch_size))
+                    if not batch:
+                        break
+
+                    for i, n in enumerate(self._import_batch(batch, pool, roles_cache, default_roles)):
+                        totals[i] += n
+
+                    # Checkpoint is replaced atomically, so an interrupted import never leaves it broken
+                    offset = batch[-1][0]
+                    if checkpoint:
+                        with open(checkpoint + '.tmp', 'w') as f:
+                            f.write(str(offset))
+                        replace(checkpoint + '.tmp', checkpoint)
+
+                    console.print_info(lang.t('auth@import_progress', {
+                        'processed': offset,
+                        'created': totals[0],
+                        'rate': int(totals[0] / max(time() - started, 0.001)),
+                    }))
+
+        except (ValueError, _error.Error, NotImplementedError) as e:
+            raise console.error.CommandExecutionError(e)
+
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        console.print_success(lang.t('auth@import_finished', {
+            'created': totals[0],
+            'skipped': totals[1],
+            'failed': totals[2],
+            'seconds': round(time() - started, 1),
+        }))
+
+
+class Export(console.Command):
+    """auth:export Console Command
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Str('format'))
+        self.define_option(console.option.Str('fields', default=_EXPORT_FIELDS))
+        self.define_option(console.option.Str('filter'))
+        self.define_option(console.option.Str('shard'))
+        self.define_option(console.option.Int('batch', default=1000))
+
+    @property
+    def name(self) -> str:
+        """Get command's name
+        """
+        return 'auth:export'
+
+    @property
+    def description(self) -> str:
+        """Get command's description
+        """
+        return 'auth@export_console_command_description'
+
+    @staticmethod
+    def _make_query(filter_json: Optional[str], shard: Optional[str]) -> Optional[query.Query]:
+        """Make a query from JSON filter and shard specification
+
+        Filter maps field names to values or to {operator: value} objects, e.g. {"status": "active"}. Shard 'i/n' selects
+        the i-th of n equal ranges of hexadecimal UIDs.
+        """
+        q = query.Query()
+
+        for field, cond in (json.loads(filter_json) if filter_json else {}).items():
+            for op, arg in (cond.items() if isinstance(cond, dict) else [('$eq', cond)]):
+                if op not in _QUERY_OPS:
+                    raise ValueError("Query operator '{}' is not supported".format(op))
+                q.add(_QUERY_OPS[op](field, arg))
+
+        if shard:
+            index, count = (int(v) for v in shard.split('/'))
+            if not 0 <= index < count:
+                raise ValueError("Invalid shard '{}'".format(shard))
+
+            space = 16 ** 24
+            q.add(query.Gte('uid', '{:024x}'.format(space * index // count)))
+            if index < count - 1:
+                q.add(query.Lt('uid', '{:024x}'.format(space * (index + 1) // count)))
+
+        return q if len(q) else None
+
+    @staticmethod
+    def _to_jsonable(value: Any) -> Any:
+        """Convert a field's value to a JSON serializable one
+        """
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, _model.AbstractRole):
+            return value.name
+        if isinstance(value, _model.AuthEntity):
+            return value.uid
+        if isinstance(value, (list, tuple)):
+            return [Export._to_jsonable(v) for v in value]
+
+        return value
+
+    def exec(self):
+        """Execute the command
+        """
+        dst = self.arg(0) or '-'
+        fmt = self.opt('format') or ('csv' if dst.endswith('.csv') else 'jsonl')
+        if fmt not in ('jsonl', 'csv'):
+            raise console.error.CommandExecutionError(lang.t('auth@import_export_invalid_format', {'format': fmt}))
+
+        fields = [f.strip() for f in self.opt('fields').split(',') if f.strip()]
+        batch_size = max(self.opt('batch'), 1)
+
+        try:
+            q = self._make_query(self.opt('filter'), self.opt('shard'))
+        except ValueError as e:
+            raise console.error.CommandExecutionError(e)
+
+        stream = sys.stdout if dst == '-' else open(dst, 'w', newline='', encoding='utf-8')
+        writer = csv.DictWriter(stream, fields, extrasaction='ignore') if fmt == 'csv' else None
+        if writer:
+            writer.writeheader()
+
+        count = 0
+        started = time()
+        try:
+            # Pages are fetched by UID order using keyset pagination, so only one page is kept in memory
+            cursor = None
+            while True:
+                users, cursor = _api.find_users_page(q, [('uid', 1)], batch_size, cursor, fields)
+
+                for user in users:
+                    row = {f: self._to_jsonable(user.get_field(f)) for f in fields}
+                    if writer:
+                        writer.writerow({k: ','.join(map(str, v)) if isinstance(v, list) else v
+                                         for k, v in row.items()})
+                    else:
+                        stream.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+                count += len(users)
+                stream.flush()
+
+                if not cursor:
+                    break
+
+        except (ValueError, _error.Error) as e:
+            raise console.error.CommandExecutionError(e)
+
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        # Data written to stdout must not be mixed with messages
+        if stream is not sys.stdout:
+            console.print_info(lang.t('auth@export_finished', {'count': count, 'seconds': round(time() - started, 1)}))
@@ -0,0 +1,208 @@
+"""PytSite Auth Plugin Maintained Counters
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from typing import Any, Dict, Optional, Tuple
+from collections import OrderedDict
+from threading import Lock
+from pytsite import cache, reg
+from plugins import query
+from . import _model
+
+_pool = cache.create_pool('auth.counters')
+_lock = Lock()
+_counters = OrderedDict()  # type: Dict[str, Tuple[dict, Optional[query.Query], Any]]
+_saving = {}  # type: Dict[str, dict]  # UID of user being saved: its membership before saving
+_membership_ttl = reg.get('auth.user_counters_membership_ttl', 86400)
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+
+    return value.uid if isinstance(value, _model.AuthEntity) else value
+
+
+def _matches(user: _model.AbstractUser, conditions: dict) -> bool:
+    """Check if the user matches all conditions
+
+    A condition on a list field, such as roles, matches if the list contains the value.
+    """
+    for field, value in conditions.items():
+        actual, value = _normalize(user.get_field(field)), _normalize(value)
+        if isinstance(actual, list) and not isinstance(value, list):
+            if value not in actual:
+                return False
+        elif actual != value:
+            return False
+
+    return True
+
+
+def register(name: str, conditions: dict):
+    """Register a counter of users matching conditions
+    """
+    if name in _counters:
+        raise KeyError("User counter '{}' is already registered".format(name))
+
+    q = query.Query(*[query.Eq(f, v) for f, v in conditions.items()]) if conditions else None
+    _counters[name] = (dict(conditions), q, q.compile() if q else None)
+
+
+def find(q: Optional[query.Query]) -> Optional[str]:
+    """Find a counter which counts users matching the query
+    """
+    if not _counters:
+        return None
+
+    compiled = q.compile() if q else None
+    for name, (_, _, c_compiled) in _counters.items():
+        if c_compiled == compiled:
+            return name
+
+
+def get(name: str) -> int:
+    """Get value of a counter
+
+    Counter which has not been initialized yet or has been dropped is counted by the storage driver.
+    """
+    from . import _api
+
+    if name not in _counters:
+        raise KeyError("User counter '{}' is not registered".format(name))
+
+    try:
+        return _pool.get('count:' + name)
+    except cache.error.KeyNotExist:
+        count = _api.get_storage_driver().count_users(_counters[name][1])
+        _pool.put('count:' + name, count)
+        return count
+
+
+def reconcile():
+    """Recount all counters by the storage driver
+
+    """
+    from . import _api
+
+    for name, (_, q, _) in _counters.items():
+        _pool.put('count:' + name, _api.get_storage_driver().count_users(q))
+
+    drop_roles()
+
+
+def _add(name: str, delta: int):
+    # Increments are not atomic between processes, periodic reconciliation fixes the drift
+    with _lock:
+        try:
+            _pool.put('count:' + name, _pool.get('count:' + name) + delta)
+        except cache.error.KeyNotExist:
+            pass  # Will be counted by the storage driver on first use
+
+
+def _drop(name: str):
+    try:
+        _pool.rm('count:' + name)
+    except cache.error.KeyNotExist:
+        pass
+
+
+def _get_membership(uid: str) -> Optional[dict]:
+    try:
+        return _pool.get('member:' + uid)
+    except cache.error.KeyNotExist:
+        return None
+
+
+def _update(uid: str, previous: Optional[dict], current: dict):
+    """Apply the difference between previous and current counters membership of a user
+
+    Counters the user's previous membership in is unknown are dropped, to be recounted by the storage driver.
+    """
+    for name, is_member in current.items():
+        if previous is None or name not in previous:
+            _drop(name)
+        elif previous[name] != is_member:
+            _add(name, 1 if is_member else -1)
+
+    _pool.put('member:' + uid, current, _membership_ttl)
+
+
+def _get_stored_membership(user: _model.AbstractUser) -> Optional[dict]:
+    """Compute counters membership of the user as it is stored
+    """
+    from . import _api, _error
+
+    try:
+        stored = _api.get_storage_driver().get_user(uid=user.uid)
+    except _error.UserNotFound:
+        return None
+
+    return {name: _matches(stored, c[0]) for name, c in _counters.items()} if stored else None
+
+
+def on_user_pre_save(user: _model.AbstractUser):
+    if not _counters:
+        return
+
+    if user.is_new:
+        _saving[user.uid] = {name: False for name in _counters}
+    else:
+        # Membership of users which have not been saved since counters were set up is computed by the stored state
+        _saving[user.uid] = _get_membership(user.uid) or _get_stored_membership(user)
+
+
+def on_user_save(user: _model.AbstractUser):
+    if not _counters:
+        return
+
+    previous = _saving.pop(user.uid, None) or _get_membership(user.uid)
+
+    _update(user.uid, previous, {name: _matches(user, c[0]) for name, c in _counters.items()})
+
+
+def on_user_save_failed(user: _model.AbstractUser):
+    _saving.pop(user.uid, None)
+
+
+def on_user_create(user: _model.AbstractUser):
+    # Usually the user is already counted while being saved
+    if _counters and _get_membership(user.uid) is None:
+        _update(user.uid, {name: False for name in _counters},
+                {name: _matches(user, c[0]) for name, c in _counters.items()})
+
+
+def on_user_delete(user: _model.AbstractUser):
+    if not _counters:
+        return
+
+    # A user being deleted is as it is stored
+    previous = _get_membership(user.uid) or {name: _matches(user, c[0]) for name, c in _counters.items()}
+    _update(user.uid, previous, {name: False for name in _counters})
+
+    try:
+        _pool.rm('member:' + user.uid)
+    except cache.error.KeyNotExist:
+        pass
+
+
+def count_roles() -> int:
+    """Get total number of roles
+    """
+    from . import _api
+
+    try:
+        return _pool.get('roles')
+    except cache.error.KeyNotExist:
+        count = _api.get_storage_driver().count_roles(None)
+        _pool.put('roles', count)
+        return count
+
+
+def drop_roles():
+    try:
+        _pool.rm('roles')
+    except cache.error.KeyNotExist:
+        pass
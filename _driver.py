@@ -4,10 +4,11 @@ __author__ = 'Oleksandr Shepetko'
 __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
-from typing import Iterator, List, Tuple
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 from abc import ABC, abstractmethod
+from plugins import query
 from plugins.query import Query
-from . import _model
+from . import _error, _model, _pagination, _batch
 
 
 class Authentication(ABC):
@@ -72,19 +73,127 @@ class Storage(ABC):
                    skip: int = 0) -> Iterator[_model.AbstractRole]:
         pass
 
+    def find_roles_page(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = 100,
+                        cursor: str = None) -> Tuple[List[_model.AbstractRole], Optional[str]]:
+        """Find a page of roles using keyset pagination
+
+        See find_users_page().
+        """
+        return _pagination.find_page(self.find_roles, query, sort, limit, cursor)
+
     @abstractmethod
     def create_user(self, login: str, password: str = None) -> _model.AbstractUser:
         pass
 
+    def insert_user(self, login: str, password: str = None, status: str = 'active',
+                    roles: List[_model.AbstractRole] = None, is_confirmed: bool = True) -> _model.AbstractUser:
+        """Create a new user and store it with a single write
+
+        Raises error.UserExists if a user with the same login exists. Default implementation checks it with a separate
+        lookup, so it is not atomic, drivers should override it relying on a uniqueness constraint of their storage.
+        """
+        if self.get_user(login):
+            raise _error.UserExists()
+
+        user = self.create_user(login, password)
+        user.status = status
+        user.is_confirmed = is_confirmed
+        user.roles = roles or []
+
+        with _batch.suspend():
+            return user.save()
+
+    def insert_users(self, items: List[dict]) -> List[Union[_model.AbstractUser, Exception]]:
+        """Create new users and store them with a single bulk write
+
+        Each item contains 'login', 'password_hash' and optionally 'status', 'roles', 'is_confirmed' and other fields.
+        Returns a list of created users in order of items, where items which could not be inserted are represented by
+        exceptions, e.g. error.UserExists. Drivers must fire 'auth@user_pre_save' and 'auth@user_save' events for each
+        user, as AbstractUser.save() does.
+        """
+        raise NotImplementedError("Storage driver '{}' does not support bulk insert".format(self.get_name()))
+
+    def save_entities(self, entities: List[_model.AuthEntity]) -> List[Optional[Exception]]:
+        """Store users and roles with a single bulk write
+
+        Events are fired by the caller. Returns a list of errors in order of entities, None for saved ones.
+        """
+        r = []
+        for entity in entities:
+            try:
+                entity.do_save()
+                r.append(None)
+            except Exception as e:
+                r.append(e)
+
+        return r
+
     @abstractmethod
     def get_user(self, login: str = None, nickname: str = None, uid: str = None) -> _model.AbstractUser:
         pass
 
+    def get_partial_user(self, login: str = None, nickname: str = None, uid: str = None,
+                         fields: List[str] = None) -> Optional[_model.PartialUser]:
+        """Get a user with only specified fields loaded
+
+        Default implementation loads the whole user, drivers should override it to load only necessary fields.
+        """
+        user = self.get_user(login, nickname, uid)
+
+        return _model.PartialUser.from_user(user, fields) if user else None
+
+    def get_users(self, uids: List[str] = None, logins: List[str] = None,
+                  nicknames: List[str] = None) -> List[_model.AbstractUser]:
+        """Get several users at once
+
+        Users are returned in order of arguments, non-existent ones are skipped. Drivers are also expected to resolve
+        users referenced by 'follows', 'followers' and 'blocked_users' fields with this method. Default implementation
+        fetches all users with a single query.
+        """
+        lookups = [(f, values) for f, values in (('uid', uids), ('login', logins), ('nickname', nicknames)) if values]
+        if not lookups:
+            return []
+
+        ops = [query.In(f, list(values)) for f, values in lookups]
+        found = {}
+        for user in self.find_users(query.Query(ops[0] if len(ops) == 1 else query.Or(*ops))):
+            for f, _ in lookups:
+                found[(f, user.get_field(f))] = user
+
+        r = []
+        seen = set()
+        for f, values in lookups:
+            for value in values:
+                user = found.get((f, value))
+                if user and user.uid not in seen:
+                    seen.add(user.uid)
+                    r.append(user)
+
+        return r
+
     @abstractmethod
     def find_users(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
                    skip: int = 0) -> Iterator[_model.AbstractUser]:
         pass
 
+    def find_partial_users(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                           skip: int = 0, fields: List[str] = None) -> Iterator[_model.PartialUser]:
+        """Find users with only specified fields loaded
+
+        Default implementation loads whole users, drivers should override it to load only necessary fields.
+        """
+        return (_model.PartialUser.from_user(user, fields) for user in self.find_users(query, sort, limit, skip))
+
+    def find_users_page(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = 100,
+                        cursor: str = None) -> Tuple[List[_model.AbstractUser], Optional[str]]:
+        """Find a page of users using keyset pagination
+
+        Returns users and the cursor of the next page, which is None for the last page. UID is appended to sort keys to
+        make the order total. Default implementation turns the cursor into a query condition on sort keys, so a page
+        costs the same at any depth, provided the storage has an index on these keys.
+        """
+        return _pagination.find_page(self.find_users, query, sort, limit, cursor)
+
     @abstractmethod
     def count_users(self, query: Query = None) -> int:
         pass
@@ -92,3 +201,65 @@ class Storage(ABC):
     @abstractmethod
     def count_roles(self, query: Query = None) -> int:
         pass
+
+
+class InvalidationBus(ABC):
+    """Delivers cache invalidation messages to all processes of the application
+    """
+
+    @abstractmethod
+    def get_name(self) -> str:
+        pass
+
+    @abstractmethod
+    def publish(self, channel: str, keys: List[str]):
+        """Notify subscribers of all processes about invalidated keys
+        """
+        pass
+
+    @abstractmethod
+    def subscribe(self, channel: str, handler: Callable[[List[str]], None]):
+        """Subscribe to invalidation messages of the current process
+        """
+        pass
+
+
+class PasswordHasher(ABC):
+    """Password hashing scheme
+
+    Hashes are expected in the '<name>:<params>$<salt>$<hash>' format, so the scheme can be detected from a hash.
+    """
+
+    @abstractmethod
+    def get_name(self) -> str:
+        pass
+
+    @abstractmethod
+    def hash(self, secret: str, params: dict = None) -> str:
+        """Hash a secret using given or default parameters
+        """
+        pass
+
+    @abstractmethod
+    def verify(self, clear_text: str, hashed: str) -> bool:
+        """Check a secret against a hash
+        """
+        pass
+
+    @abstractmethod
+    def get_params(self, hashed: str) -> dict:
+        """Get parameters a hash was made with
+        """
+        pass
+
+    @abstractmethod
+    def get_default_params(self) -> dict:
+        """Get parameters new hashes are made with
+        """
+        pass
+
+    @abstractmethod
+    def calibrate(self, target_time: float) -> dict:
+        """Find parameters which make hashing take about `target_time` seconds on the current host
+        """
+        pass
@@ -5,7 +5,7 @@ __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
 from pytsite import lang, console, reg
-from . import _api, _error, _driver
+from . import _api, _error, _driver, _identity_map, _counter
 
 
 def on_register_storage_driver(driver: _driver.Storage):
@@ -29,3 +29,68 @@ def on_register_storage_driver(driver: _driver.Storage):
     # Switch user context
     if reg.get('env.type') == 'console':
         _api.switch_user_to_system()
+
+
+def on_user_status_change(user, **kwargs):
+    # Drop cached copies of the user in all processes
+    _api.publish_invalidation('auth.users', [user.uid])
+
+
+def on_user_create(user):
+    # User is not missing anymore
+    _api.publish_invalidation('auth.missing_users', _api.get_user_lookup_keys(user))
+
+    _counter.on_user_create(user)
+
+
+def on_user_pre_save(user):
+    _counter.on_user_pre_save(user)
+
+
+def on_user_save(user):
+    _api.publish_invalidation('auth.users', [user.uid])
+    _api.publish_invalidation('auth.missing_users', _api.get_user_lookup_keys(user))
+
+    _counter.on_user_save(user)
+
+    # Login or nickname could be changed, so re-key the user
+    i_map = _identity_map.get_current()
+    if i_map and user in i_map:
+        i_map.add(user)
+
+
+def on_user_delete(user):
+    _api.publish_invalidation('auth.users', [user.uid])
+
+    _counter.on_user_delete(user)
+
+    i_map = _identity_map.get_current()
+    if i_map:
+        i_map.discard(user)
+
+
+def on_role_save(role):
+    _counter.drop_roles()
+
+    i_map = _identity_map.get_current()
+    if i_map and role in i_map:
+        i_map.add(role)
+
+
+def on_role_delete(user):
+    _counter.drop_roles()
+
+    # Role is passed as 'user' argument by AbstractRole.delete()
+    i_map = _identity_map.get_current()
+    if i_map:
+        i_map.discard(user)
+
+
+def on_router_dispatch(**kwargs):
+    # Unit of work lasts for a request, any leftovers of a failed previous one are dropped
+    _identity_map.end()
+    _identity_map.begin()
+
+
+def on_router_response(**kwargs):
+    _identity_map.end()
@@ -31,6 +31,18 @@ class SignUpError(Error):
         return self._msg or lang.t('auth@sign_up_error')
 
 
+class SignInThrottled(Error):
+    def __init__(self, retry_after: int):
+        self._retry_after = retry_after
+
+    @property
+    def retry_after(self) -> int:
+        return self._retry_after
+
+    def __str__(self) -> str:
+        return lang.t('auth@sign_in_throttled', {'seconds': self._retry_after})
+
+
 class NoDriverRegistered(Error):
     pass
 
@@ -87,6 +99,33 @@ class InvalidAccessToken(Error):
     pass
 
 
+class PasswordHasherBusy(Error):
+    pass
+
+
+class FieldNotLoaded(Error):
+    def __init__(self, field_name: str):
+        self._field_name = field_name
+
+    def __str__(self) -> str:
+        return "Field '{}' is not loaded".format(self._field_name)
+
+
+class BatchSaveError(Error):
+    def __init__(self, failed: list):
+        self._failed = failed
+
+    @property
+    def failed(self) -> list:
+        """Get failed entities along with their errors
+        """
+        return self._failed
+
+    def __str__(self) -> str:
+        return '{} entities have not been saved: {}'.format(len(self._failed), '; '.join(
+            '{}: {}'.format(entity.uid, e) for entity, e in self._failed))
+
+
 class UserModifyForbidden(Error):
     pass
 
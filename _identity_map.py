@@ -0,0 +1,84 @@
+"""PytSite Auth Plugin Identity Map
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from typing import Dict, List, Optional, Tuple
+from pytsite import threading
+from . import _model
+
+_maps = {}  # type: Dict[int, IdentityMap]  # Per thread
+
+
+class IdentityMap:
+    """Keeps a single instance of each entity within a unit of work
+
+    Users are keyed by UID, login and nickname, roles by UID and name.
+    """
+
+    _KEY_FIELDS = {
+        'user': ('uid', 'login', 'nickname'),
+        'role': ('uid', 'name'),
+    }
+
+    def __init__(self):
+        self._entities = {}  # type: Dict[Tuple[str, str, str], _model.AuthEntity]
+        self._keys = {}  # type: Dict[Tuple[str, str], List[Tuple[str, str, str]]]
+
+    def get(self, e_type: str, **kwargs) -> Optional[_model.AuthEntity]:
+        """Get an entity by any of its key fields
+        """
+        for field, value in kwargs.items():
+            if value:
+                return self._entities.get((e_type, field, value))
+
+    def add(self, entity: _model.AuthEntity):
+        """Add an entity or update its keys
+        """
+        self.discard(entity)
+
+        e_type = entity.auth_entity_type
+        keys = []
+        for field in self._KEY_FIELDS[e_type]:
+            value = entity.get_field(field)
+            if value:
+                keys.append((e_type, field, value))
+                self._entities[(e_type, field, value)] = entity
+
+        self._keys[(e_type, entity.uid)] = keys
+
+    def discard(self, entity: _model.AuthEntity):
+        """Remove an entity
+        """
+        for key in self._keys.pop((entity.auth_entity_type, entity.uid), ()):
+            self._entities.pop(key, None)
+
+    def __contains__(self, entity: _model.AuthEntity) -> bool:
+        return (entity.auth_entity_type, entity.uid) in self._keys
+
+
+def begin() -> bool:
+    """Start a unit of work in the current thread
+
+    Returns False if the thread is already inside a unit of work.
+    """
+    tid = threading.get_id()
+    if tid in _maps:
+        return False
+
+    _maps[tid] = IdentityMap()
+
+    return True
+
+
+def end():
+    """Finish the unit of work of the current thread
+    """
+    _maps.pop(threading.get_id(), None)
+
+
+def get_current() -> Optional[IdentityMap]:
+    """Get identity map of the current unit of work
+    """
+    return _maps.get(threading.get_id()) or _maps.get(threading.get_parent_id())
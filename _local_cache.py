@@ -0,0 +1,142 @@
+"""PytSite Auth Plugin In-process Caching
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from typing import Any, Callable, Dict, Iterable, List
+from collections import OrderedDict
+from hashlib import blake2b
+from math import ceil, log
+from threading import Lock
+from time import time
+from . import _driver
+
+
+class LocalCache:
+    """Bounded in-process LRU cache with per-item TTL
+
+    Cache of zero size stores nothing, so it can be used as a disabled one.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._items = OrderedDict()  # key: (expires, value)
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get an item
+
+        Lookups of a disabled cache are not counted.
+        """
+        if not self._max_size:
+            return default
+
+        with self._lock:
+            item = self._items.get(key)
+
+            if item is None or item[0] <= time():
+                if item is not None:
+                    del self._items[key]
+                self._misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self._hits += 1
+
+            return item[1]
+
+    def put(self, key: str, value: Any, ttl: float = None):
+        """Put an item
+
+        Item's TTL cannot exceed the cache's one.
+        """
+        if not self._max_size:
+            return
+
+        ttl = self._ttl if ttl is None else min(ttl, self._ttl)
+
+        with self._lock:
+            self._items[key] = (time() + ttl, value)
+            self._items.move_to_end(key)
+
+            while len(self._items) > self._max_size:
+                self._items.popitem(False)
+
+    def invalidate(self, keys: Iterable[str]):
+        """Remove items
+        """
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        """Remove all items
+        """
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self) -> dict:
+        """Get usage statistics
+        """
+        return {
+            'enabled': self.enabled,
+            'hits': self._hits,
+            'misses': self._misses,
+            'size': len(self._items),
+            'max_size': self._max_size,
+        }
+
+
+class BloomFilter:
+    """Bloom Filter
+
+    Tells for sure that a key has never been added, with no false negatives and a tunable rate of false positives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self._size = max(int(ceil(-capacity * log(error_rate) / log(2) ** 2)), 8)
+        self._hashes = max(int(round(self._size / capacity * log(2))), 1)
+        self._bits = bytearray(self._size // 8 + 1)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # Double hashing, all positions are derived from two halves of a single digest
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big')
+
+        return ((h1 + i * h2) % self._size for i in range(self._hashes))
+
+    def add(self, keys: Iterable[str]):
+        for key in keys:
+            for pos in self._positions(key):
+                self._bits[pos // 8] |= 1 << pos % 8
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos // 8] & 1 << pos % 8 for pos in self._positions(key))
+
+
+class LocalInvalidationBus(_driver.InvalidationBus):
+    """In-process Invalidation Bus
+
+    Delivers messages to subscribers of the current process only, which is enough for single process setups and tests.
+    """
+
+    def __init__(self):
+        self._handlers = {}  # type: Dict[str, List[Callable[[List[str]], None]]]
+
+    def get_name(self) -> str:
+        return 'local'
+
+    def publish(self, channel: str, keys: List[str]):
+        for handler in self._handlers.get(channel, ()):
+            handler(keys)
+
+    def subscribe(self, channel: str, handler: Callable[[List[str]], None]):
+        self._handlers.setdefault(channel, []).append(handler)
@@ -0,0 +1,505 @@
+"""PytSite Auth Plugin In-memory Storage Driver
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from copy import deepcopy
+from threading import RLock
+from plugins.query import Query
+from . import _driver, _error, _model, _storage_model, _batch
+
+_RANGE_OPS = ('$gt', '$gte', '$lt', '$lte')
+_MAX_UID = chr(0x10ffff)  # Greater than any UID
+
+
+def _sort_key(value: Any) -> tuple:
+    # None goes before any other value, as in MongoDB
+    return (0, '') if value is None else (1, value)
+
+
+def _is_op_dict(value: Any) -> bool:
+    return isinstance(value, dict) and bool(value) and all(str(k).startswith('$') for k in value)
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, (list, tuple, set)):
+        return [_normalize(v) for v in value]
+
+    return _storage_model.to_uid(value)
+
+
+def _compare(actual: Any, arg: Any, op: str) -> bool:
+    if isinstance(actual, list):
+        return any(_compare(v, arg, op) for v in actual)
+
+    if actual is None or arg is None:
+        return False
+
+    try:
+        if op == '$gt':
+            return actual > arg
+        if op == '$gte':
+            return actual >= arg
+        if op == '$lt':
+            return actual < arg
+        return actual <= arg
+    except TypeError:
+        return False
+
+
+def _equals(actual: Any, arg: Any) -> bool:
+    if isinstance(actual, list) and not isinstance(arg, list):
+        return arg in actual
+
+    return actual == arg
+
+
+def _match_field(actual: Any, cond: Any) -> bool:
+    if not _is_op_dict(cond):
+        cond = {'$eq': cond}
+
+    for op, arg in cond.items():
+        arg = _normalize(arg) if op != '$not' else arg
+
+        if op == '$eq':
+            ok = _equals(actual, arg)
+        elif op == '$ne':
+            ok = not _equals(actual, arg)
+        elif op == '$in':
+            ok = any(_equals(actual, a) for a in arg)
+        elif op == '$nin':
+            ok = not any(_equals(actual, a) for a in arg)
+        elif op in _RANGE_OPS:
+            ok = _compare(actual, arg, op)
+        elif op == '$exists':
+            ok = (actual is not None) == bool(arg)
+        elif op == '$regex':
+            flags = re.I if 'i' in cond.get('$options', '') else 0
+            values = actual if isinstance(actual, list) else [actual]
+            ok = any(v is not None and re.search(arg, str(v), flags) for v in values)
+        elif op == '$options':
+            ok = True
+        elif op == '$not':
+            ok = not _match_field(actual, arg)
+        else:
+            raise ValueError("Query operator '{}' is not supported".format(op))
+
+        if not ok:
+            return False
+
+    return True
+
+
+def match(record: dict, cond: dict) -> bool:
+    """Check if a record matches a compiled query
+    """
+    for key, value in cond.items():
+        if key == '$and':
+            ok = all(match(record, c) for c in value)
+        elif key == '$or':
+            ok = any(match(record, c) for c in value)
+        elif key == '$nor':
+            ok = not any(match(record, c) for c in value)
+        elif str(key).startswith('$'):
+            raise ValueError("Query operator '{}' is not supported".format(key))
+        else:
+            ok = _match_field(record.get(key), value)
+
+        if not ok:
+            return False
+
+    return True
+
+
+def compile_query(query: Optional[Query]) -> dict:
+    return query.compile() if query else {}
+
+
+def sort_records(records: List[dict], sort: Optional[List[Tuple[str, int]]]) -> List[dict]:
+    """Sort records by several keys
+    """
+    for field, direction in reversed(sort or []):
+        records.sort(key=lambda r: _sort_key(r.get(field)), reverse=direction < 0)
+
+    return records
+
+
+class HashIndex:
+    """Maps values of a field to UIDs of records
+
+    Each element of a list field is indexed separately.
+    """
+
+    def __init__(self, field: str):
+        self._field = field
+        self._items = {}  # type: Dict[Any, Set[str]]
+
+    def _values(self, record: dict) -> list:
+        value = record.get(self._field)
+        values = value if isinstance(value, list) else [value]
+
+        return [v for v in values if v is not None]
+
+    def add(self, record: dict):
+        for value in self._values(record):
+            self._items.setdefault(value, set()).add(record['uid'])
+
+    def remove(self, record: dict):
+        for value in self._values(record):
+            uids = self._items.get(value)
+            if uids:
+                uids.discard(record['uid'])
+                if not uids:
+                    del self._items[value]
+
+    def get(self, value: Any) -> Set[str]:
+        try:
+            return self._items.get(value, set())
+        except TypeError:  # Unhashable value
+            return set()
+
+
+class SortedIndex:
+    """Keeps UIDs of records ordered by values of a field
+    """
+
+    def __init__(self, field: str):
+        self._field = field
+        self._items = []  # type: List[Tuple[tuple, str]]
+
+    def _entry(self, record: dict) -> Tuple[tuple, str]:
+        return _sort_key(record.get(self._field)), record['uid']
+
+    def add(self, record: dict):
+        insort(self._items, self._entry(record))
+
+    def remove(self, record: dict):
+        entry = self._entry(record)
+        i = bisect_left(self._items, entry)
+        if i < len(self._items) and self._items[i] == entry:
+            del self._items[i]
+
+    def range(self, cond: dict) -> Set[str]:
+        """Get UIDs of records which values match range conditions
+        """
+        lo, hi = 0, len(self._items)
+        for op, arg in cond.items():
+            if arg is None:
+                return set()
+            key = _sort_key(arg)
+            try:
+                if op == '$gt':
+                    lo = max(lo, bisect_right(self._items, (key, _MAX_UID)))
+                elif op == '$gte':
+                    lo = max(lo, bisect_left(self._items, (key, '')))
+                elif op == '$lt':
+                    hi = min(hi, bisect_left(self._items, (key, '')))
+                elif op == '$lte':
+                    hi = min(hi, bisect_right(self._items, (key, _MAX_UID)))
+            except TypeError:  # Incomparable value
+                return set()
+
+        # Records having no value never match a range
+        lo = max(lo, bisect_left(self._items, ((1,), '')))
+
+        return {uid for _, uid in self._items[lo:hi]}
+
+    def iter_uids(self, direction: int) -> Iterator[str]:
+        items = self._items if direction >= 0 else reversed(self._items)
+
+        return (uid for _, uid in items)
+
+
+class MemoryStorage(_driver.Storage):
+    """In-memory Storage Driver
+
+    Keeps all data in the process memory, so it is suitable for tests, benchmarks and as a read replica cache. Users are
+    indexed by login, nickname, status, roles and follows using hash indexes, and by common sort keys using sorted ones.
+    Queries are evaluated against indexes first, and candidates are checked against the whole query then.
+    """
+
+    HASH_INDEXES = ('login', 'nickname', 'status', 'roles', 'follows')
+    SORTED_INDEXES = ('created', 'login', 'nickname', 'last_sign_in', 'last_activity')
+
+    def __init__(self):
+        self._lock = RLock()
+        self._roles = OrderedDict()  # type: Dict[str, dict]
+        self._role_names = {}  # type: Dict[str, str]
+        self._users = OrderedDict()  # type: Dict[str, dict]
+        self._hash_indexes = {f: HashIndex(f) for f in self.HASH_INDEXES}
+        self._sorted_indexes = {f: SortedIndex(f) for f in self.SORTED_INDEXES}
+
+    def get_name(self) -> str:
+        return 'memory'
+
+    def _make_role(self, record: dict) -> _storage_model.Role:
+        return _storage_model.Role(self, deepcopy(record))
+
+    def _make_user(self, record: dict) -> _storage_model.User:
+        return _storage_model.User(self, deepcopy(record))
+
+    def create_role(self, name: str, description: str = '') -> _model.AbstractRole:
+        with self._lock:
+            if name in self._role_names:
+                raise _error.RoleAlreadyExists(name)
+
+        return _storage_model.Role.create(self, name, description)
+
+    def get_role(self, name: str = None, uid: str = None) -> _model.AbstractRole:
+        with self._lock:
+            if name:
+                uid = self._role_names.get(name)
+            record = self._roles.get(uid)
+
+            if not record:
+                raise _error.RoleNotFound(name or uid)
+
+            return self._make_role(record)
+
+    def _find_role_records(self, query: Query = None, sort: List[Tuple[str, int]] = None) -> List[dict]:
+        cond = compile_query(query)
+        with self._lock:
+            records = [r for r in self._roles.values() if match(r, cond)]
+
+        return sort_records(records, sort)
+
+    def find_roles(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                   skip: int = 0) -> Iterator[_model.AbstractRole]:
+        records = self._find_role_records(query, sort)
+        records = records[skip:skip + limit] if limit else records[skip:]
+
+        return (self._make_role(r) for r in records)
+
+    def count_roles(self, query: Query = None) -> int:
+        return len(self._find_role_records(query))
+
+    def save_role(self, role: _storage_model.Role):
+        with self._lock:
+            record = deepcopy(role.record)
+            owner = self._role_names.get(record['name'])
+            if owner and owner != record['uid']:
+                raise _error.RoleAlreadyExists(record['name'])
+
+            old = self._roles.get(record['uid'])
+            if old:
+                self._role_names.pop(old['name'], None)
+
+            self._roles[record['uid']] = record
+            self._role_names[record['name']] = record['uid']
+
+    def save_entities(self, entities: List[_model.AuthEntity]) -> List[Optional[Exception]]:
+        # Other threads see either none or all of the entities
+        with self._lock:
+            return super().save_entities(entities)
+
+    def delete_role(self, role: _storage_model.Role):
+        with self._lock:
+            record = self._roles.pop(role.uid, None)
+            if record:
+                self._role_names.pop(record['name'], None)
+
+    def create_user(self, login: str, password: str = None) -> _model.AbstractUser:
+        user = _storage_model.User.create(self, login, password)
+        with self._lock:
+            user.set_field('nickname', _storage_model.make_nickname(login, self._hash_indexes['nickname'].get))
+
+        return user
+
+    def insert_user(self, login: str, password: str = None, status: str = 'active',
+                    roles: List[_model.AbstractRole] = None, is_confirmed: bool = True) -> _model.AbstractUser:
+        return _storage_model.insert_user(self, login, password, status, roles, is_confirmed)
+
+    def insert_users(self, items: List[dict]) -> List[Union[_model.AbstractUser, Exception]]:
+        r = []
+        with self._lock, _batch.suspend():
+            for item in items:
+                try:
+                    nickname = item.get('nickname') or _storage_model.make_nickname(
+                        item['login'], self._hash_indexes['nickname'].get)
+                    r.append(_storage_model.make_user(self, item, nickname).save())
+                except Exception as e:
+                    r.append(e)
+
+        return r
+
+    def get_user(self, login: str = None, nickname: str = None, uid: str = None) -> _model.AbstractUser:
+        with self._lock:
+            if uid:
+                record = self._users.get(uid)
+                if record and (not login or record['login'] == login) and \
+                        (not nickname or record['nickname'] == nickname):
+                    return self._make_user(record)
+                return None
+
+            for field, value in (('login', login), ('nickname', nickname)):
+                if value:
+                    for found_uid in self._hash_indexes[field].get(value):
+                        return self._make_user(self._users[found_uid])
+                    return None
+
+    def get_users(self, uids: List[str] = None, logins: List[str] = None,
+                  nicknames: List[str] = None) -> List[_model.AbstractUser]:
+        r = []
+        seen = set()
+        with self._lock:
+            for field, values in (('uid', uids), ('login', logins), ('nickname', nicknames)):
+                for value in values or ():
+                    found = {value} if field == 'uid' else self._hash_indexes[field].get(value)
+                    for uid in found:
+                        if uid in self._users and uid not in seen:
+                            seen.add(uid)
+                            r.append(self._make_user(self._users[uid]))
+
+        return r
+
+    def get_follower_uids(self, uid: str) -> List[str]:
+        with self._lock:
+            return sorted(self._hash_indexes['follows'].get(uid))
+
+    def load_user_fields(self, uid: str, field_names: Iterable[str]) -> dict:
+        with self._lock:
+            record = self._users.get(uid, {})
+
+            return {f: deepcopy(record.get(f)) for f in field_names}
+
+    def _candidates(self, cond: dict) -> Optional[Set[str]]:
+        """Get UIDs of records which may match a compiled query using indexes
+
+        Returns None if indexes cannot narrow the search.
+        """
+        r = None
+        for key, value in cond.items():
+            found = None
+
+            if key == '$and':
+                for sub in value:
+                    sub_found = self._candidates(sub)
+                    if sub_found is not None:
+                        found = sub_found if found is None else found & sub_found
+
+            elif key == '$or':
+                subs = [self._candidates(sub) for sub in value]
+                if subs and all(s is not None for s in subs):
+                    found = set().union(*subs)
+
+            elif not str(key).startswith('$'):
+                found = self._field_candidates(key, value if _is_op_dict(value) else {'$eq': value})
+
+            if found is not None:
+                r = found if r is None else r & found
+
+        return r
+
+    def _field_candidates(self, field: str, cond: dict) -> Optional[Set[str]]:
+        if field == 'uid':
+            if '$eq' in cond:
+                return {_normalize(cond['$eq'])}
+            if '$in' in cond:
+                return set(_normalize(cond['$in']))
+
+        if field in self._hash_indexes:
+            index = self._hash_indexes[field]
+            if '$eq' in cond and not isinstance(cond['$eq'], (list, tuple)):
+                return set(index.get(_normalize(cond['$eq'])))
+            if '$in' in cond:
+                return set().union(*[index.get(v) for v in _normalize(cond['$in'])])
+
+        range_cond = {op: _normalize(arg) for op, arg in cond.items() if op in _RANGE_OPS}
+        if range_cond and field in self._sorted_indexes:
+            return self._sorted_indexes[field].range(range_cond)
+
+        return None
+
+    def _find_user_records(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                           skip: int = 0) -> List[dict]:
+        cond = compile_query(query)
+        sort = sort or []
+
+        with self._lock:
+            candidates = self._candidates(cond)
+
+            # Walk a sorted index if it gives the requested order, so only necessary records are checked
+            first = sort[0] if sort else None
+            if first and first[0] in self._sorted_indexes and \
+                    all(s == ('uid', first[1]) for s in sort[1:]) and (candidates is None or len(candidates) > 1000):
+                r = []
+                for uid in self._sorted_indexes[first[0]].iter_uids(first[1]):
+                    if candidates is not None and uid not in candidates:
+                        continue
+                    record = self._users[uid]
+                    if match(record, cond):
+                        r.append(record)
+                        if limit and len(r) >= skip + limit:
+                            break
+
+                return r[skip:]
+
+            if candidates is None:
+                records = [r for r in self._users.values() if match(r, cond)]
+            else:
+                records = [self._users[u] for u in candidates if u in self._users]
+                records = [r for r in records if match(r, cond)]
+                if not sort:
+                    # Keep insertion order as a full scan does
+                    sort = [('created', 1), ('uid', 1)]
+
+        records = sort_records(records, sort)
+
+        return records[skip:skip + limit] if limit else records[skip:]
+
+    def find_users(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                   skip: int = 0) -> Iterator[_model.AbstractUser]:
+        return (self._make_user(r) for r in self._find_user_records(query, sort, limit, skip))
+
+    def count_users(self, query: Query = None) -> int:
+        if not query:
+            return len(self._users)
+
+        return len(self._find_user_records(query))
+
+    def _index(self, record: dict):
+        for index in self._hash_indexes.values():
+            index.add(record)
+        for index in self._sorted_indexes.values():
+            index.add(record)
+
+    def _unindex(self, record: dict):
+        for index in self._hash_indexes.values():
+            index.remove(record)
+        for index in self._sorted_indexes.values():
+            index.remove(record)
+
+    def save_user(self, user: _storage_model.User):
+        with self._lock:
+            record = deepcopy(user.record)
+            old = self._users.get(record['uid'])
+
+            for field in ('login', 'nickname'):
+                if record[field] and self._hash_indexes[field].get(record[field]) - {record['uid']}:
+                    raise _error.UserExists()
+
+            if old:
+                self._unindex(old)
+                record = dict(old, **record)  # Keep fields the user has not loaded
+
+            self._users[record['uid']] = record
+            self._index(record)
+
+    def delete_user(self, user: _storage_model.User):
+        with self._lock:
+            record = self._users.pop(user.uid, None)
+            if not record:
+                return
+
+            self._unindex(record)
+
+            # Drop references to the user
+            for uid in list(self._hash_indexes['follows'].get(user.uid)):
+                self._unindex(self._users[uid])
+                self._users[uid]['follows'].remove(user.uid)
+                self._index(self._users[uid])
@@ -5,11 +5,12 @@ __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
 from abc import ABC, abstractmethod
-from typing import Union as Union, Tuple, List, Any
+from typing import Union as Union, Tuple, List, Any, Iterable
 from datetime import datetime
 from pytz import timezone
 from pytsite import util, events, errors, lang
 from plugins import permissions, geo_ip, file, query
+from . import _error
 
 ANONYMOUS_USER_LOGIN = 'anonymous@anonymous.anonymous'
 SYSTEM_USER_LOGIN = 'system@system.system'
@@ -84,6 +85,45 @@ class AuthEntity(ABC):
     def sub_from_field(self, field_name: str, value):
         raise NotImplementedError()
 
+    def defer_fields(self, field_names: Iterable[str]):
+        """Mark fields as not loaded yet
+
+        Drivers call it while hydrating an entity to skip loading of heavy fields. All deferred fields are loaded at once
+        by load_deferred_fields() on first access to any of them.
+        """
+        self._deferred_fields = set(field_names)
+
+    def get_deferred_fields(self) -> Tuple[str, ...]:
+        """Get names of fields which are not loaded yet
+
+        Drivers must not overwrite these fields in storage while saving the entity.
+        """
+        return tuple(sorted(getattr(self, '_deferred_fields', ())))
+
+    def load_deferred_fields(self, field_names: List[str]):
+        """Load values of deferred fields from storage
+
+        Drivers which defer fields must implement it.
+        """
+        raise NotImplementedError()
+
+    def resolve_deferred_field(self, field_name: str):
+        """Make sure a field is loaded
+
+        Drivers which defer fields should call it in get_field(), set_field(), add_to_field() and sub_from_field().
+        """
+        deferred = getattr(self, '_deferred_fields', None)
+        if not deferred or field_name not in deferred:
+            return
+
+        # Fields are marked as loaded before loading to let the driver access them
+        self._deferred_fields = set()
+        try:
+            self.load_deferred_fields(sorted(deferred))
+        except Exception:
+            self._deferred_fields = deferred
+            raise
+
     def __eq__(self, other) -> bool:
         return isinstance(other, self.__class__) and other.uid == self.uid
 
@@ -140,6 +180,14 @@ class AbstractRole(AuthEntity):
         raise NotImplementedError()
 
     def save(self):
+        from . import _batch
+
+        # Saving is postponed until the end of the batch
+        batch = _batch.get_current()
+        if batch is not None:
+            batch.add(self)
+            return self
+
         events.fire('auth@role_pre_save', role=self)
         self.do_save()
         events.fire('auth@role_save', role=self)
@@ -174,6 +222,10 @@ class AbstractUser(AuthEntity):
     """Abstract User Model
     """
 
+    # Fields which are worth to be deferred by drivers
+    deferrable_fields = ('description', 'picture', 'cover_picture', 'urls', 'options', 'follows', 'followers',
+                         'blocked_users')
+
     def _check_user(self, value):
         if isinstance(value, (list, tuple)):
             for u in value:
@@ -672,14 +724,26 @@ class AbstractUser(AuthEntity):
         raise NotImplementedError()
 
     def save(self):
+        from . import _batch, _counter
+
         if self.is_anonymous:
             raise RuntimeError('Anonymous user cannot be saved')
 
         if self.is_system:
             raise RuntimeError('System user cannot be saved')
 
+        # Saving is postponed until the end of the batch
+        batch = _batch.get_current()
+        if batch is not None:
+            batch.add(self)
+            return self
+
         events.fire('auth@user_pre_save', user=self)
-        self.do_save()
+        try:
+            self.do_save()
+        except Exception:
+            _counter.on_user_save_failed(self)
+            raise
         events.fire('auth@user_save', user=self)
 
         return self
@@ -770,3 +834,56 @@ class AbstractUser(AuthEntity):
 
     def __str__(self) -> str:
         return self.login
+
+
+class PartialUser(AbstractUser):
+    """Partially Loaded User Model
+
+    Holds only a subset of user's fields, accessing any other field raises error.FieldNotLoaded. Partial users are
+    read-only.
+    """
+
+    def __init__(self, fields: dict):
+        self._fields = fields
+
+    @classmethod
+    def from_user(cls, user: AbstractUser, fields: Iterable[str]):
+        """Make a partial copy of a user
+        """
+        return cls({f: user.get_field(f) for f in set(fields) | {'uid'}})
+
+    @property
+    def is_new(self) -> bool:
+        return False
+
+    @property
+    def is_modified(self) -> bool:
+        return False
+
+    @property
+    def created(self) -> datetime:
+        return self.get_field('created')
+
+    def has_field(self, field_name: str) -> bool:
+        return field_name in self._fields
+
+    def get_field(self, field_name: str, **kwargs) -> Any:
+        try:
+            return self._fields[field_name]
+        except KeyError:
+            raise _error.FieldNotLoaded(field_name)
+
+    def set_field(self, field_name: str, value):
+        raise RuntimeError('Partial user cannot be modified')
+
+    def add_to_field(self, field_name: str, value):
+        raise RuntimeError('Partial user cannot be modified')
+
+    def sub_from_field(self, field_name: str, value):
+        raise RuntimeError('Partial user cannot be modified')
+
+    def do_save(self):
+        raise RuntimeError('Partial user cannot be saved')
+
+    def do_delete(self):
+        raise RuntimeError('Partial user cannot be deleted')
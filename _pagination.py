@@ -0,0 +1,115 @@
+"""PytSite Auth Plugin Keyset Pagination Helpers
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import json
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from plugins import query as _query
+from . import _model
+
+
+def normalize_sort(sort: Optional[List[Tuple[str, int]]]) -> List[Tuple[str, int]]:
+    """Make sort order total by adding UID as the last key
+    """
+    sort = list(sort or [])
+    if not any(field == 'uid' for field, _ in sort):
+        sort.append(('uid', 1))
+
+    return sort
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, _model.AuthEntity):
+        return value.uid
+
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and 'dt' in value:
+        return datetime.strptime(value['dt'], '%Y-%m-%dT%H:%M:%S.%f' if '.' in value['dt'] else '%Y-%m-%dT%H:%M:%S')
+
+    return value
+
+
+def make_cursor(entity: _model.AuthEntity, sort: List[Tuple[str, int]]) -> str:
+    """Make a cursor pointing right after the entity
+    """
+    values = [_encode_value(entity.get_field(field)) for field, _ in sort]
+    data = json.dumps(values, separators=(',', ':')).encode()
+
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def parse_cursor(cursor: str, sort: List[Tuple[str, int]]) -> list:
+    """Get values of sort keys from a cursor
+    """
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (ValueError, BinasciiError):
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise ValueError('Cursor does not match sort order')
+
+    return [_decode_value(v) for v in values]
+
+
+def make_keyset_query(q: Optional[_query.Query], sort: List[Tuple[str, int]], values: list) -> _query.Query:
+    """Extend a query to match only entities which follow given sort keys values
+
+    For sort keys (k1, k2, k3) it is k1 > v1 OR (k1 = v1 AND k2 > v2) OR (k1 = v1 AND k2 = v2 AND k3 > v3), where '>'
+    becomes '<' for keys sorted in descending order.
+
+    None goes before any other value, as in MongoDB and SQL, but never matches '>' and '<', so it is handled
+    separately: any non-None value follows None in ascending order, nothing follows it in descending order, and None
+    follows any other value in descending order.
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        value = values[i]
+        if direction >= 0:
+            after_op = _query.Ne(field, None) if value is None else _query.Gt(field, value)
+        elif value is None:
+            continue
+        else:
+            after_op = _query.Or(_query.Lt(field, value), _query.Eq(field, None))
+
+        ops = [_query.Eq(f, v) for (f, _), v in zip(sort[:i], values[:i])]
+        ops.append(after_op)
+        branches.append(ops[0] if len(ops) == 1 else _query.And(*ops))
+
+    if not branches:
+        keyset_op = _query.In('uid', [])  # Nothing follows
+    else:
+        keyset_op = branches[0] if len(branches) == 1 else _query.Or(*branches)
+
+    return _query.Query(*(list(q) if q else []), keyset_op)
+
+
+def find_page(finder: Callable[..., Iterator[_model.AuthEntity]], q: Optional[_query.Query],
+              sort: Optional[List[Tuple[str, int]]], limit: int,
+              cursor: Optional[str]) -> Tuple[List[_model.AuthEntity], Optional[str]]:
+    """Find a page of entities using a finder which accepts query, sort and limit arguments
+
+    Zero limit means no limit, so all remaining entities are returned as the last page.
+    """
+    sort = normalize_sort(sort)
+    if cursor:
+        q = make_keyset_query(q, sort, parse_cursor(cursor, sort))
+
+    if limit < 1:
+        return list(finder(q, sort, 0)), None
+
+    # One extra entity tells whether there is a next page
+    entities = list(finder(q, sort, limit + 1))
+    next_cursor = make_cursor(entities[limit - 1], sort) if len(entities) > limit else None
+
+    return entities[:limit], next_cursor
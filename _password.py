@@ -0,0 +1,275 @@
+"""PytSite Auth Plugin Passwords Hashing
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import asyncio
+import hashlib
+import hmac
+from typing import Awaitable, Callable, Dict
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from pytsite import reg, util
+from . import _error, _driver
+
+_workers = reg.get('auth.password_hasher_workers', 0)  # 0 means hashing in the calling thread
+_max_pending = reg.get('auth.password_hasher_max_pending', _workers * 16)
+_queue_timeout = reg.get('auth.password_hasher_queue_timeout', 5)  # seconds
+_executor = None  # type: ProcessPoolExecutor
+_executor_lock = Lock()
+_slots = BoundedSemaphore(max(_max_pending, 1))
+_stats_lock = Lock()
+_stats = {
+    'submitted': 0,
+    'completed': 0,
+    'rejected': 0,
+}
+
+
+def _split(hashed: str) -> tuple:
+    """Split a hash into name, parameters, salt and hash parts
+    """
+    method, salt, digest = hashed.split('$', 2)
+    name, _, params = method.partition(':')
+
+    return name, params.split(':') if params else [], salt, digest
+
+
+class Pbkdf2Hasher(_driver.PasswordHasher):
+    """PBKDF2 Password Hasher
+
+    Produces hashes compatible with Werkzeug's ones.
+    """
+
+    def get_name(self) -> str:
+        return 'pbkdf2'
+
+    def hash(self, secret: str, params: dict = None) -> str:
+        params = params or self.get_default_params()
+        salt = util.random_str(16)
+        digest = hashlib.pbkdf2_hmac(params['hash_name'], secret.encode(), salt.encode(), params['iterations'])
+
+        return 'pbkdf2:{}:{}${}${}'.format(params['hash_name'], params['iterations'], salt, digest.hex())
+
+    def verify(self, clear_text: str, hashed: str) -> bool:
+        _, params, salt, digest = _split(hashed)
+        computed = hashlib.pbkdf2_hmac(params[0], clear_text.encode(), salt.encode(), int(params[1]))
+
+        return hmac.compare_digest(computed.hex(), digest)
+
+    def get_params(self, hashed: str) -> dict:
+        params = _split(hashed)[1]
+
+        return {'hash_name': params[0], 'iterations': int(params[1])}
+
+    def get_default_params(self) -> dict:
+        return dict({'hash_name': 'sha256', 'iterations': 260000}, **reg.get('auth.password_hasher_pbkdf2', {}))
+
+    def calibrate(self, target_time: float) -> dict:
+        params = self.get_default_params()
+
+        # PBKDF2 time is linear to the number of iterations
+        sample = 10000
+        start = perf_counter()
+        hashlib.pbkdf2_hmac(params['hash_name'], b'secret', b'salt', sample)
+        params['iterations'] = max(int(sample * target_time / (perf_counter() - start)), sample)
+
+        return params
+
+
+class ScryptHasher(_driver.PasswordHasher):
+    """Scrypt Password Hasher
+
+    Memory-hard scheme, produces hashes compatible with Werkzeug's ones.
+    """
+
+    def get_name(self) -> str:
+        return 'scrypt'
+
+    @staticmethod
+    def _digest(secret: str, salt: str, n: int, r: int, p: int) -> str:
+        return hashlib.scrypt(secret.encode(), salt=salt.encode(), n=n, r=r, p=p, maxmem=132 * n * r * p).hex()
+
+    def hash(self, secret: str, params: dict = None) -> str:
+        params = params or self.get_default_params()
+        salt = util.random_str(16)
+        digest = self._digest(secret, salt, params['n'], params['r'], params['p'])
+
+        return 'scrypt:{}:{}:{}${}${}'.format(params['n'], params['r'], params['p'], salt, digest)
+
+    def verify(self, clear_text: str, hashed: str) -> bool:
+        _, params, salt, digest = _split(hashed)
+
+        return hmac.compare_digest(self._digest(clear_text, salt, *(int(p) for p in params)), digest)
+
+    def get_params(self, hashed: str) -> dict:
+        n, r, p = (int(p) for p in _split(hashed)[1])
+
+        return {'n': n, 'r': r, 'p': p}
+
+    def get_default_params(self) -> dict:
+        return dict({'n': 32768, 'r': 8, 'p': 1}, **reg.get('auth.password_hasher_scrypt', {}))
+
+    def calibrate(self, target_time: float) -> dict:
+        params = self.get_default_params()
+
+        # Scrypt's N must be a power of two
+        params['n'] = 1024
+        while True:
+            start = perf_counter()
+            self._digest('secret', 'salt', params['n'], params['r'], params['p'])
+            if perf_counter() - start >= target_time / 2:
+                break
+            params['n'] *= 2
+
+        return params
+
+
+_hashers = {h.get_name(): h for h in (Pbkdf2Hasher(), ScryptHasher())}  # type: Dict[str, _driver.PasswordHasher]
+
+
+def register_hasher(hasher: _driver.PasswordHasher):
+    """Register a password hasher
+    """
+    if not isinstance(hasher, _driver.PasswordHasher):
+        raise TypeError('Instance of {} expected'.format(type(_driver.PasswordHasher)))
+
+    _hashers[hasher.get_name()] = hasher
+
+
+def get_hasher(name: str = None) -> _driver.PasswordHasher:
+    """Get a password hasher, by default the one new hashes are made with
+    """
+    name = name or reg.get('auth.password_hasher', 'pbkdf2')
+    if name not in _hashers:
+        raise _error.DriverNotRegistered("Password hasher '{}' is not registered".format(name))
+
+    return _hashers[name]
+
+
+def _detect_hasher(hashed: str) -> _driver.PasswordHasher:
+    """Get the hasher a hash was made with
+
+    Returns None for hashes made by unknown schemes or by old Werkzeug versions, which did not store all parameters.
+    """
+    try:
+        hasher = _hashers.get(_split(hashed)[0])
+        if hasher:
+            hasher.get_params(hashed)
+        return hasher
+    except (ValueError, IndexError):
+        return None
+
+
+def hash_secret(secret: str) -> str:
+    """Hash a password in the current process
+    """
+    return get_hasher().hash(secret)
+
+
+def check_secret(clear_text: str, hashed: str) -> bool:
+    """Verify a password in the current process
+    """
+    hasher = _detect_hasher(hashed)
+    if hasher:
+        return hasher.verify(clear_text, hashed)
+
+    from werkzeug.security import check_password_hash
+    return check_password_hash(hashed, clear_text)
+
+
+def needs_rehash(hashed: str) -> bool:
+    """Check if a hash was made with other scheme or parameters than new hashes are made with
+    """
+    hasher = _detect_hasher(hashed)
+    current = get_hasher()
+
+    return hasher is not current or hasher.get_params(hashed) != current.get_default_params()
+
+
+def is_pool_enabled() -> bool:
+    return _workers > 0
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Get the pool, creating it on first use, i.e. after web server's workers are forked
+    """
+    global _executor
+
+    with _executor_lock:
+        if not _executor:
+            _executor = ProcessPoolExecutor(_workers)
+
+    return _executor
+
+
+def _on_done(future: Future):
+    _slots.release()
+
+    with _stats_lock:
+        _stats['completed'] += 1
+
+
+def submit(fn: Callable, *args, blocking: bool = True) -> Future:
+    """Submit a job to the pool
+
+    Waits for a free slot not longer than auth.password_hasher_queue_timeout seconds, or does not wait at all if
+    `blocking` is False.
+    """
+    if not (_slots.acquire(timeout=_queue_timeout) if blocking else _slots.acquire(False)):
+        with _stats_lock:
+            _stats['rejected'] += 1
+        raise _error.PasswordHasherBusy('Too many pending password hashing jobs')
+
+    # Counted before submitting, otherwise a quickly done job may be counted as completed before being submitted
+    with _stats_lock:
+        _stats['submitted'] += 1
+
+    try:
+        future = _get_executor().submit(fn, *args)
+    except Exception:
+        with _stats_lock:
+            _stats['submitted'] -= 1
+        _slots.release()
+        raise
+
+    future.add_done_callback(_on_done)
+
+    return future
+
+
+def run(fn: Callable, *args):
+    """Run a job synchronously, in the pool if it is enabled
+    """
+    return submit(fn, *args).result() if is_pool_enabled() else fn(*args)
+
+
+def run_async(fn: Callable, *args) -> Awaitable:
+    """Run a job without blocking the event loop
+
+    Event loop should never wait for a slot, so the job is rejected at once if the pool is full. Must be called from
+    a coroutine or a callback of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+
+    if is_pool_enabled():
+        return asyncio.wrap_future(submit(fn, *args, blocking=False), loop=loop)
+
+    return loop.run_in_executor(None, fn, *args)
+
+
+def get_stats() -> dict:
+    """Get pool usage statistics
+    """
+    with _stats_lock:
+        r = dict(_stats)
+        r['pending'] = _stats['submitted'] - _stats['completed']
+
+    r.update({
+        'workers': _workers,
+        'max_pending': _max_pending,
+    })
+
+    return r
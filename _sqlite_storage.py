@@ -0,0 +1,576 @@
+"""PytSite Auth Plugin SQLite Storage Driver
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import re
+import json
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from datetime import datetime
+from threading import local
+from pytsite import events
+from plugins import file, query
+from plugins.query import Query
+from . import _counter, _driver, _error, _model, _storage_model
+
+_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS auth_roles (
+    uid TEXT PRIMARY KEY,
+    created TEXT NOT NULL,
+    name TEXT NOT NULL UNIQUE,
+    description TEXT NOT NULL DEFAULT '',
+    permissions TEXT NOT NULL DEFAULT '[]'
+);
+
+CREATE TABLE IF NOT EXISTS auth_users (
+    uid TEXT PRIMARY KEY,
+    created TEXT NOT NULL,
+    login TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL DEFAULT '',
+    confirmation_hash TEXT,
+    is_confirmed INTEGER NOT NULL DEFAULT 1,
+    nickname TEXT NOT NULL UNIQUE,
+    first_name TEXT NOT NULL DEFAULT '',
+    middle_name TEXT NOT NULL DEFAULT '',
+    last_name TEXT NOT NULL DEFAULT '',
+    position TEXT NOT NULL DEFAULT '',
+    description TEXT NOT NULL DEFAULT '',
+    timezone TEXT NOT NULL DEFAULT 'UTC',
+    birth_date TEXT,
+    last_sign_in TEXT,
+    last_activity TEXT,
+    sign_in_count INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    gender TEXT NOT NULL DEFAULT '',
+    phone INTEGER,
+    options TEXT NOT NULL DEFAULT '{}',
+    picture TEXT,
+    cover_picture TEXT,
+    urls TEXT NOT NULL DEFAULT '[]',
+    is_public INTEGER NOT NULL DEFAULT 0,
+    last_ip TEXT NOT NULL DEFAULT '',
+    country TEXT NOT NULL DEFAULT '',
+    postal_code TEXT NOT NULL DEFAULT '',
+    province TEXT NOT NULL DEFAULT '',
+    city TEXT NOT NULL DEFAULT '',
+    district TEXT NOT NULL DEFAULT '',
+    street TEXT NOT NULL DEFAULT '',
+    building TEXT NOT NULL DEFAULT '',
+    apt_number TEXT NOT NULL DEFAULT ''
+);
+
+-- Lookups by login and nickname use indexes of unique constraints, counting and listing by status is covered
+CREATE INDEX IF NOT EXISTS auth_users_status ON auth_users (status, created, uid);
+CREATE INDEX IF NOT EXISTS auth_users_created ON auth_users (created, uid);
+CREATE INDEX IF NOT EXISTS auth_users_last_sign_in ON auth_users (last_sign_in, uid);
+CREATE INDEX IF NOT EXISTS auth_users_last_activity ON auth_users (last_activity, uid);
+
+CREATE TABLE IF NOT EXISTS auth_user_roles (
+    user_uid TEXT NOT NULL REFERENCES auth_users (uid) ON DELETE CASCADE,
+    role_uid TEXT NOT NULL REFERENCES auth_roles (uid) ON DELETE CASCADE,
+    PRIMARY KEY (user_uid, role_uid)
+);
+CREATE INDEX IF NOT EXISTS auth_user_roles_role ON auth_user_roles (role_uid, user_uid);
+
+CREATE TABLE IF NOT EXISTS auth_user_follows (
+    user_uid TEXT NOT NULL REFERENCES auth_users (uid) ON DELETE CASCADE,
+    follows_uid TEXT NOT NULL REFERENCES auth_users (uid) ON DELETE CASCADE,
+    PRIMARY KEY (user_uid, follows_uid)
+);
+CREATE INDEX IF NOT EXISTS auth_user_follows_follows ON auth_user_follows (follows_uid, user_uid);
+
+CREATE TABLE IF NOT EXISTS auth_user_blocked_users (
+    user_uid TEXT NOT NULL REFERENCES auth_users (uid) ON DELETE CASCADE,
+    blocked_user_uid TEXT NOT NULL REFERENCES auth_users (uid) ON DELETE CASCADE,
+    PRIMARY KEY (user_uid, blocked_user_uid)
+);
+CREATE INDEX IF NOT EXISTS auth_user_blocked_users_blocked ON auth_user_blocked_users (blocked_user_uid, user_uid);
+"""
+
+_ROLE_COLUMNS = ('uid', 'created', 'name', 'description', 'permissions')
+
+_USER_COLUMNS = ('uid', 'created') + tuple(f for f in _storage_model.USER_DEFAULTS
+                                           if f not in _storage_model.USER_REF_FIELDS)
+
+# Heavy fields, loaded on first access to any of them
+_USER_DEFERRED_FIELDS = ('description', 'options', 'urls', 'picture', 'cover_picture', 'follows', 'blocked_users')
+
+_USER_EAGER_COLUMNS = tuple(c for c in _USER_COLUMNS if c not in _USER_DEFERRED_FIELDS)
+
+# Join tables of fields which reference other entities: field: (table, column)
+_USER_REF_TABLES = {
+    'roles': ('auth_user_roles', 'role_uid'),
+    'follows': ('auth_user_follows', 'follows_uid'),
+    'blocked_users': ('auth_user_blocked_users', 'blocked_user_uid'),
+}
+
+_DATETIME_FIELDS = ('created', 'birth_date', 'last_sign_in', 'last_activity')
+_BOOL_FIELDS = ('is_confirmed', 'is_public')
+_JSON_FIELDS = ('permissions', 'options', 'urls')
+_FILE_FIELDS = ('picture', 'cover_picture')
+
+_RANGE_OPS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def _to_db(field: str, value: Any) -> Any:
+    value = _storage_model.to_uid(value)
+
+    if value is None:
+        return None
+    if field in _DATETIME_FIELDS:
+        return value.strftime(_DATETIME_FORMAT)
+    if field in _BOOL_FIELDS:
+        return int(value)
+    if field in _JSON_FIELDS:
+        return json.dumps(value)
+    if field in _FILE_FIELDS:
+        return value.uid
+
+    return value
+
+
+def _from_db(field: str, value: Any) -> Any:
+    if value is None:
+        return None
+    if field in _DATETIME_FIELDS:
+        return datetime.strptime(value, _DATETIME_FORMAT)
+    if field in _BOOL_FIELDS:
+        return bool(value)
+    if field in _JSON_FIELDS:
+        return json.loads(value)
+    if field in _FILE_FIELDS:
+        return file.get(value)
+
+    return value
+
+
+def _is_op_dict(value: Any) -> bool:
+    return isinstance(value, dict) and bool(value) and all(str(k).startswith('$') for k in value)
+
+
+def _regexp(pattern: str, value: Any) -> bool:
+    return value is not None and re.search(pattern, str(value)) is not None
+
+
+class _QueryTranslator:
+    """Translates compiled queries into SQL conditions
+    """
+
+    def __init__(self, columns: Iterable[str], ref_tables: Dict[str, Tuple[str, str]]):
+        self._columns = tuple(c for c in columns if c not in _JSON_FIELDS)
+        self._ref_tables = ref_tables
+
+    def where(self, cond: dict, params: list) -> str:
+        parts = []
+        for key, value in cond.items():
+            if key in ('$and', '$or', '$nor'):
+                subs = ['({})'.format(self.where(c, params)) for c in value]
+                joined = (' OR ' if key != '$and' else ' AND ').join(subs) or ('0' if key == '$or' else '1')
+                parts.append('NOT ({})'.format(joined) if key == '$nor' else '({})'.format(joined))
+            elif str(key).startswith('$'):
+                raise ValueError("Query operator '{}' is not supported".format(key))
+            elif key in self._ref_tables:
+                parts.append(self._ref_where(key, value if _is_op_dict(value) else {'$eq': value}, params))
+            elif key in self._columns:
+                parts.append(self._column_where(key, value if _is_op_dict(value) else {'$eq': value}, params))
+            else:
+                raise ValueError("Field '{}' cannot be queried".format(key))
+
+        return ' AND '.join(parts) or '1'
+
+    def _ref_where(self, field: str, cond: dict, params: list) -> str:
+        table, column = self._ref_tables[field]
+        parts = []
+        for op, arg in cond.items():
+            if op in ('$eq', '$ne') and not isinstance(arg, (list, tuple)):
+                sql = 'uid IN (SELECT user_uid FROM {} WHERE {} = ?)'.format(table, column)
+                params.append(_storage_model.to_uid(arg))
+            elif op in ('$in', '$nin'):
+                sql = 'uid IN (SELECT user_uid FROM {} WHERE {} IN ({}))'.format(table, column, ','.join('?' * len(arg)))
+                params.extend(_storage_model.to_uid(a) for a in arg)
+            elif op == '$exists':
+                sql = 'uid IN (SELECT user_uid FROM {})'.format(table)
+            else:
+                raise ValueError("Query operator '{}' is not supported for field '{}'".format(op, field))
+
+            negate = op in ('$ne', '$nin') or (op == '$exists' and not arg)
+            parts.append('NOT ' + sql if negate else sql)
+
+        return ' AND '.join(parts)
+
+    def _column_where(self, field: str, cond: dict, params: list) -> str:
+        parts = []
+        for op, arg in cond.items():
+            if op == '$options':
+                continue
+
+            if op == '$not':
+                parts.append('NOT ({})'.format(
+                    self._column_where(field, arg if _is_op_dict(arg) else {'$eq': arg}, params)))
+                continue
+
+            if op in ('$in', '$nin'):
+                values = [_to_db(field, a) for a in arg]
+                non_null = [v for v in values if v is not None]
+                sql = '{} IN ({})'.format(field, ','.join('?' * len(non_null))) if non_null else '0'
+                params.extend(non_null)
+                if None in values:
+                    sql = '({} OR {} IS NULL)'.format(sql, field)
+
+                # NULL never matches IN, so it has to be matched by NOT IN explicitly
+                if op == '$nin':
+                    sql = 'NOT ' + sql if None in values else '(NOT {} OR {} IS NULL)'.format(sql, field)
+
+                parts.append(sql)
+                continue
+
+            if op == '$exists':
+                parts.append('{} IS {}NULL'.format(field, 'NOT ' if arg else ''))
+                continue
+
+            if op == '$regex':
+                parts.append('{} REGEXP ?'.format(field))
+                params.append(('(?i)' if 'i' in cond.get('$options', '') else '') + arg)
+                continue
+
+            value = _to_db(field, arg)
+            if op == '$eq':
+                if value is None:
+                    parts.append('{} IS NULL'.format(field))
+                else:
+                    parts.append('{} = ?'.format(field))
+                    params.append(value)
+            elif op == '$ne':
+                if value is None:
+                    parts.append('{} IS NOT NULL'.format(field))
+                else:
+                    parts.append('({0} != ? OR {0} IS NULL)'.format(field))
+                    params.append(value)
+            elif op in _RANGE_OPS:
+                parts.append('{} {} ?'.format(field, _RANGE_OPS[op]))
+                params.append(value)
+            else:
+                raise ValueError("Query operator '{}' is not supported".format(op))
+
+        return ' AND '.join(parts) or '1'
+
+    def order_by(self, sort: Optional[List[Tuple[str, int]]]) -> str:
+        if not sort:
+            return ''
+
+        for field, _ in sort:
+            if field not in self._columns:
+                raise ValueError("Field '{}' cannot be sorted by".format(field))
+
+        return ' ORDER BY ' + ', '.join('{} {}'.format(f, 'DESC' if d < 0 else 'ASC') for f, d in sort)
+
+
+class SqliteStorage(_driver.Storage):
+    """SQLite Storage Driver
+
+    Persistent storage for single node setups and tests. Each thread uses its own connection, the database works in WAL
+    mode, so readers do not block the writer. Queries are translated into SQL, fields referencing other entities are
+    kept in join tables, heavy fields are loaded lazily.
+    """
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self._path = path
+        self._timeout = timeout
+        self._local = local()
+        self._roles_sql = _QueryTranslator(_ROLE_COLUMNS, {})
+        self._users_sql = _QueryTranslator(_USER_COLUMNS, _USER_REF_TABLES)
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+
+    def get_name(self) -> str:
+        return 'sqlite'
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Statements are prepared once and then reused from the connection's cache
+            conn = sqlite3.connect(self._path, timeout=self._timeout, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA foreign_keys=ON')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('REGEXP', 2, _regexp)
+            self._local.conn = conn
+
+        return conn
+
+    def _select(self, table: str, columns: Iterable[str], translator: _QueryTranslator, query: Optional[Query],
+                sort: List[Tuple[str, int]] = None, limit: int = None, skip: int = 0) -> List[sqlite3.Row]:
+        params = []
+        sql = 'SELECT {} FROM {} WHERE {}'.format(', '.join(columns), table,
+                                                 translator.where(query.compile() if query else {}, params))
+        sql += translator.order_by(sort)
+        if limit or skip:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [limit or -1, skip or 0]
+
+        return self._conn().execute(sql, params).fetchall()
+
+    def _count(self, table: str, translator: _QueryTranslator, query: Optional[Query]) -> int:
+        params = []
+        sql = 'SELECT COUNT(*) FROM {} WHERE {}'.format(table, translator.where(query.compile() if query else {},
+                                                                               params))
+
+        return self._conn().execute(sql, params).fetchone()[0]
+
+    def _make_role(self, row: sqlite3.Row) -> _storage_model.Role:
+        return _storage_model.Role(self, {c: _from_db(c, row[c]) for c in _ROLE_COLUMNS})
+
+    def create_role(self, name: str, description: str = '') -> _model.AbstractRole:
+        if self._conn().execute('SELECT 1 FROM auth_roles WHERE name = ?', (name,)).fetchone():
+            raise _error.RoleAlreadyExists(name)
+
+        return _storage_model.Role.create(self, name, description)
+
+    def get_role(self, name: str = None, uid: str = None) -> _model.AbstractRole:
+        field, value = ('name', name) if name else ('uid', uid)
+        row = self._conn().execute('SELECT {} FROM auth_roles WHERE {} = ?'.format(', '.join(_ROLE_COLUMNS), field),
+                                   (value,)).fetchone()
+        if not row:
+            raise _error.RoleNotFound(name or uid)
+
+        return self._make_role(row)
+
+    def find_roles(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                   skip: int = 0) -> Iterator[_model.AbstractRole]:
+        rows = self._select('auth_roles', _ROLE_COLUMNS, self._roles_sql, query, sort, limit, skip)
+
+        return (self._make_role(row) for row in rows)
+
+    def count_roles(self, query: Query = None) -> int:
+        return self._count('auth_roles', self._roles_sql, query)
+
+    @staticmethod
+    def _write_role(conn: sqlite3.Connection, role: _storage_model.Role):
+        values = [_to_db(c, role.record[c]) for c in _ROLE_COLUMNS]
+
+        if role.is_new:
+            conn.execute('INSERT INTO auth_roles ({}) VALUES ({})'.format(
+                ', '.join(_ROLE_COLUMNS), ','.join('?' * len(_ROLE_COLUMNS))), values)
+        else:
+            conn.execute('UPDATE auth_roles SET {} WHERE uid = ?'.format(
+                ', '.join(c + ' = ?' for c in _ROLE_COLUMNS[1:])), values[1:] + [role.uid])
+
+    def save_role(self, role: _storage_model.Role):
+        try:
+            with self._conn() as conn:
+                self._write_role(conn, role)
+        except sqlite3.IntegrityError:
+            raise _error.RoleAlreadyExists(role.name)
+
+    def delete_role(self, role: _storage_model.Role):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM auth_roles WHERE uid = ?', (role.uid,))
+
+    def create_user(self, login: str, password: str = None) -> _model.AbstractUser:
+        user = _storage_model.User.create(self, login, password)
+        user.set_field('nickname', _storage_model.make_nickname(login, lambda n: bool(self._conn().execute(
+            'SELECT 1 FROM auth_users WHERE nickname = ?', (n,)).fetchone())))
+
+        return user
+
+    def _make_users(self, rows: List[sqlite3.Row]) -> List[_storage_model.User]:
+        """Make users from rows, loading roles of all of them with a single query
+        """
+        if not rows:
+            return []
+
+        uids = [row['uid'] for row in rows]
+        roles = {uid: [] for uid in uids}
+        for user_uid, role_uid in self._conn().execute(
+                'SELECT user_uid, role_uid FROM auth_user_roles WHERE user_uid IN ({}) ORDER BY rowid'.format(
+                    ','.join('?' * len(uids))), uids):
+            roles[user_uid].append(role_uid)
+
+        r = []
+        for row in rows:
+            record = {c: _from_db(c, row[c]) for c in _USER_EAGER_COLUMNS}
+            record['roles'] = roles[row['uid']]
+            user = _storage_model.User(self, record)
+            user.defer_fields(_USER_DEFERRED_FIELDS)
+            r.append(user)
+
+        return r
+
+    def insert_user(self, login: str, password: str = None, status: str = 'active',
+                    roles: List[_model.AbstractRole] = None, is_confirmed: bool = True) -> _model.AbstractUser:
+        return _storage_model.insert_user(self, login, password, status, roles, is_confirmed)
+
+    def insert_users(self, items: List[dict]) -> List[Union[_model.AbstractUser, Exception]]:
+        conn = self._conn()
+        r = []
+        nicknames = set()
+
+        def is_taken(n: str) -> bool:
+            return n in nicknames or bool(conn.execute('SELECT 1 FROM auth_users WHERE nickname = ?', (n,)).fetchone())
+
+        for item in items:
+            try:
+                user = _storage_model.make_user(self, item, item.get('nickname') or
+                                                _storage_model.make_nickname(item['login'], is_taken))
+                nicknames.add(user.nickname)
+                events.fire('auth@user_pre_save', user=user)
+                r.append(user)
+            except Exception as e:
+                r.append(e)
+
+        # Single transaction, a failed user is rolled back to its savepoint without affecting others
+        with conn:
+            conn.execute('BEGIN')
+            for i, user in enumerate(r):
+                if isinstance(user, Exception):
+                    continue
+
+                conn.execute('SAVEPOINT insert_user')
+                try:
+                    self._write_user(conn, user)
+                except sqlite3.IntegrityError:
+                    conn.execute('ROLLBACK TO insert_user')
+                    _counter.on_user_save_failed(user)
+                    r[i] = _error.UserExists()
+                conn.execute('RELEASE insert_user')
+
+        for user in r:
+            if not isinstance(user, Exception):
+                user.mark_saved()
+                events.fire('auth@user_save', user=user)
+
+        return r
+
+    def get_user(self, login: str = None, nickname: str = None, uid: str = None) -> _model.AbstractUser:
+        q = _lookup_query(login, nickname, uid)
+        if not q:
+            return None
+
+        users = self._make_users(self._select('auth_users', _USER_EAGER_COLUMNS, self._users_sql, q, limit=1))
+
+        return users[0] if users else None
+
+    def get_partial_user(self, login: str = None, nickname: str = None, uid: str = None,
+                         fields: List[str] = None) -> Optional[_model.PartialUser]:
+        q = _lookup_query(login, nickname, uid)
+        if not q:
+            return None
+
+        users = list(self.find_partial_users(q, limit=1, fields=fields))
+
+        return users[0] if users else None
+
+    def find_partial_users(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                           skip: int = 0, fields: List[str] = None) -> Iterator[_model.PartialUser]:
+        # Only columns are selected, which lets SQLite use covering indexes
+        if not all(f in _USER_COLUMNS for f in fields):
+            return super().find_partial_users(query, sort, limit, skip, fields)
+
+        columns = ['uid'] + [f for f in fields if f != 'uid']
+        rows = self._select('auth_users', columns, self._users_sql, query, sort, limit, skip)
+
+        return (_model.PartialUser({c: _from_db(c, row[c]) for c in columns}) for row in rows)
+
+    def get_follower_uids(self, uid: str) -> List[str]:
+        return [row[0] for row in self._conn().execute(
+            'SELECT user_uid FROM auth_user_follows WHERE follows_uid = ? ORDER BY user_uid', (uid,))]
+
+    def load_user_fields(self, uid: str, field_names: Iterable[str]) -> dict:
+        r = {}
+
+        columns = [f for f in field_names if f in _USER_COLUMNS]
+        if columns:
+            row = self._conn().execute('SELECT {} FROM auth_users WHERE uid = ?'.format(', '.join(columns)),
+                                       (uid,)).fetchone()
+            if row:
+                r.update({c: _from_db(c, row[c]) for c in columns})
+
+        for field in field_names:
+            if field in _USER_REF_TABLES:
+                table, column = _USER_REF_TABLES[field]
+                r[field] = [row[0] for row in self._conn().execute(
+                    'SELECT {} FROM {} WHERE user_uid = ? ORDER BY rowid'.format(column, table), (uid,))]
+
+        return r
+
+    def find_users(self, query: Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                   skip: int = 0) -> Iterator[_model.AbstractUser]:
+        rows = self._select('auth_users', _USER_EAGER_COLUMNS, self._users_sql, query, sort, limit, skip)
+
+        return iter(self._make_users(rows))
+
+    def count_users(self, query: Query = None) -> int:
+        return self._count('auth_users', self._users_sql, query)
+
+    @staticmethod
+    def _write_user(conn: sqlite3.Connection, user: _storage_model.User):
+        deferred = user.get_deferred_fields()
+        columns = [c for c in _USER_COLUMNS if c in user.record and c not in deferred]
+        values = [_to_db(c, user.record[c]) for c in columns]
+
+        if user.is_new:
+            conn.execute('INSERT INTO auth_users ({}) VALUES ({})'.format(
+                ', '.join(columns), ','.join('?' * len(columns))), values)
+        else:
+            conn.execute('UPDATE auth_users SET {} WHERE uid = ?'.format(
+                ', '.join(c + ' = ?' for c in columns[1:])), values[1:] + [user.uid])
+
+        for field, (table, column) in _USER_REF_TABLES.items():
+            if field in user.record and field not in deferred:
+                conn.execute('DELETE FROM {} WHERE user_uid = ?'.format(table), (user.uid,))
+                conn.executemany('INSERT INTO {} (user_uid, {}) VALUES (?, ?)'.format(table, column),
+                                 [(user.uid, ref_uid) for ref_uid in user.record[field]])
+
+    def save_user(self, user: _storage_model.User):
+        try:
+            with self._conn() as conn:
+                self._write_user(conn, user)
+        except sqlite3.IntegrityError:
+            raise _error.UserExists()
+
+    def save_entities(self, entities: List[_model.AuthEntity]) -> List[Optional[Exception]]:
+        conn = self._conn()
+        r = []
+
+        # Single transaction, a failed entity is rolled back to its savepoint without affecting others
+        with conn:
+            conn.execute('BEGIN')
+            for entity in entities:
+                conn.execute('SAVEPOINT save_entity')
+                try:
+                    if isinstance(entity, _storage_model.Role):
+                        self._write_role(conn, entity)
+                    else:
+                        self._write_user(conn, entity)
+                    r.append(None)
+                except sqlite3.IntegrityError:
+                    conn.execute('ROLLBACK TO save_entity')
+                    r.append(_error.RoleAlreadyExists(entity.name) if isinstance(entity, _storage_model.Role)
+                             else _error.UserExists())
+                except Exception as e:
+                    conn.execute('ROLLBACK TO save_entity')
+                    r.append(e)
+                conn.execute('RELEASE save_entity')
+
+        for entity, error in zip(entities, r):
+            if not error:
+                entity.mark_saved()
+
+        return r
+
+    def delete_user(self, user: _storage_model.User):
+        # Rows of join tables are deleted by cascade
+        with self._conn() as conn:
+            conn.execute('DELETE FROM auth_users WHERE uid = ?', (user.uid,))
+
+
+def _lookup_query(login: str = None, nickname: str = None, uid: str = None) -> Optional[Query]:
+    ops = [query.Eq(f, v) for f, v in (('uid', uid), ('login', login), ('nickname', nickname)) if v]
+
+    return Query(*ops) if ops else None
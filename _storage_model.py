@@ -0,0 +1,319 @@
+"""PytSite Auth Plugin Built-in Storage Drivers Models
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import re
+from typing import Any, Callable, Iterable
+from copy import deepcopy
+from datetime import datetime
+from os import urandom
+from . import _model, _batch
+
+ROLE_DEFAULTS = {
+    'name': '',
+    'description': '',
+    'permissions': [],
+}
+
+USER_DEFAULTS = {
+    'login': '',
+    'password': '',
+    'confirmation_hash': None,
+    'is_confirmed': True,
+    'nickname': '',
+    'first_name': '',
+    'middle_name': '',
+    'last_name': '',
+    'position': '',
+    'description': '',
+    'timezone': 'UTC',
+    'birth_date': None,
+    'last_sign_in': None,
+    'last_activity': None,
+    'sign_in_count': 0,
+    'status': 'active',
+    'roles': [],
+    'gender': '',
+    'phone': None,
+    'options': {},
+    'picture': None,
+    'cover_picture': None,
+    'urls': [],
+    'is_public': False,
+    'follows': [],
+    'blocked_users': [],
+    'last_ip': '',
+    'country': '',
+    'postal_code': '',
+    'province': '',
+    'city': '',
+    'district': '',
+    'street': '',
+    'building': '',
+    'apt_number': '',
+}
+
+# Fields which store UIDs of referenced entities
+USER_REF_FIELDS = ('roles', 'follows', 'blocked_users')
+
+
+def new_uid() -> str:
+    """Generate an UID in the same format as MongoDB's ObjectId
+    """
+    return urandom(12).hex()
+
+
+def make_nickname(login: str, is_taken: Callable[[str], bool]) -> str:
+    """Make an unique nickname from a login
+    """
+    base = re.sub(r'[^a-z0-9\-_]', '', login.split('@')[0].lower()) or 'user'
+    nickname, i = base, 1
+    while is_taken(nickname):
+        i += 1
+        nickname = '{}-{}'.format(base, i)
+
+    return nickname
+
+
+def insert_user(storage, login: str, password: str = None, status: str = 'active', roles: list = None,
+                is_confirmed: bool = True) -> _model.AbstractUser:
+    """Create and save a user, relying on the storage's check of logins uniqueness while saving
+    """
+    user = storage.create_user(login, password)
+    user.set_field('status', status)
+    user.set_field('is_confirmed', is_confirmed)
+    user.set_field('roles', roles or [])
+
+    with _batch.suspend():
+        return user.save()
+
+
+def make_user(storage, item: dict, nickname: str) -> _model.AbstractUser:
+    """Make a new user from an item of a bulk insert
+    """
+    user = User.create(storage, item['login'])
+    user.record['password'] = item.get('password_hash') or ''
+    user.set_field('nickname', nickname)
+
+    for field, value in item.items():
+        if field not in ('login', 'password_hash'):
+            user.set_field(field, value)
+
+    return user
+
+
+def to_uid(value: Any) -> Any:
+    return value.uid if isinstance(value, _model.AuthEntity) else value
+
+
+class _Entity:
+    """Dictionary-backed entity
+
+    Storage driver keeps records, entities are their detached copies, so changes are not visible until saved.
+    """
+
+    _defaults = {}
+
+    def __init__(self, storage, record: dict, is_new: bool = False):
+        self._storage = storage
+        self._record = record
+        self._is_new = is_new
+        self._is_modified = is_new
+
+    @property
+    def record(self) -> dict:
+        return self._record
+
+    @property
+    def is_new(self) -> bool:
+        return self._is_new
+
+    @property
+    def is_modified(self) -> bool:
+        return self._is_modified
+
+    @property
+    def created(self) -> datetime:
+        return self.get_field('created')
+
+    def has_field(self, field_name: str) -> bool:
+        return field_name in ('uid', 'created') or field_name in self._defaults
+
+    def _check_field(self, field_name: str):
+        if not self.has_field(field_name):
+            raise ValueError("Field '{}' is not defined".format(field_name))
+
+    def mark_saved(self):
+        self._is_new = self._is_modified = False
+
+
+class Role(_Entity, _model.AbstractRole):
+    """Role Model of built-in storage drivers
+    """
+
+    _defaults = ROLE_DEFAULTS
+
+    @classmethod
+    def create(cls, storage, name: str, description: str = ''):
+        record = deepcopy(ROLE_DEFAULTS)
+        record.update({'uid': new_uid(), 'created': datetime.now(), 'name': name, 'description': description})
+
+        return cls(storage, record, True)
+
+    def get_field(self, field_name: str, **kwargs) -> Any:
+        self._check_field(field_name)
+
+        value = self._record.get(field_name)
+
+        return tuple(value) if field_name == 'permissions' else value
+
+    def set_field(self, field_name: str, value):
+        self._check_field(field_name)
+
+        self._record[field_name] = list(value) if field_name == 'permissions' else value
+        self._is_modified = True
+
+        return self
+
+    def add_to_field(self, field_name: str, value):
+        self._check_field(field_name)
+
+        if field_name == 'permissions':
+            if value not in self._record['permissions']:
+                self._record['permissions'].append(value)
+        else:
+            self._record[field_name] += value
+
+        self._is_modified = True
+
+        return self
+
+    def sub_from_field(self, field_name: str, value):
+        self._check_field(field_name)
+
+        if field_name == 'permissions':
+            if value in self._record['permissions']:
+                self._record['permissions'].remove(value)
+        else:
+            self._record[field_name] -= value
+
+        self._is_modified = True
+
+        return self
+
+    def do_save(self):
+        self._storage.save_role(self)
+        self.mark_saved()
+
+    def do_delete(self):
+        self._storage.delete_role(self)
+
+
+class User(_Entity, _model.AbstractUser):
+    """User Model of built-in storage drivers
+    """
+
+    _defaults = USER_DEFAULTS
+
+    @classmethod
+    def create(cls, storage, login: str, password: str = None):
+        record = deepcopy(USER_DEFAULTS)
+        record.update({'uid': new_uid(), 'created': datetime.now(), 'login': login})
+        user = cls(storage, record, True)
+
+        if password:
+            user.set_field('password', password)
+
+        return user
+
+    def has_field(self, field_name: str) -> bool:
+        return super().has_field(field_name) or field_name in ('followers', 'follows_count', 'followers_count',
+                                                                 'blocked_users_count')
+
+    def get_field(self, field_name: str, **kwargs) -> Any:
+        self._check_field(field_name)
+        self.resolve_deferred_field(field_name)
+
+        if field_name == 'roles':
+            return tuple(self._storage.get_role(uid=uid) for uid in self._record['roles'])
+
+        if field_name in ('follows', 'followers', 'blocked_users'):
+            if field_name == 'followers':
+                uids = self._storage.get_follower_uids(self.uid)
+            else:
+                uids = self._record[field_name]
+
+            skip, count = kwargs.get('skip', 0), kwargs.get('count', 0)
+            uids = uids[skip:skip + count] if count else uids[skip:]
+
+            return self._storage.get_users(uids=uids) if uids else []
+
+        if field_name == 'followers_count':
+            return len(self._storage.get_follower_uids(self.uid))
+
+        if field_name in ('follows_count', 'blocked_users_count'):
+            self.resolve_deferred_field(field_name[:-6])
+            return len(self._record[field_name[:-6]])
+
+        return self._record.get(field_name)
+
+    def set_field(self, field_name: str, value):
+        from . import _api
+
+        self._check_field(field_name)
+        self.resolve_deferred_field(field_name)
+        super().set_field(field_name, value)
+
+        if field_name in USER_REF_FIELDS:
+            value = [to_uid(v) for v in value]
+        elif field_name == 'password':
+            value = _api.hash_password(value) if value else ''
+        elif field_name in ('options', 'urls'):
+            value = deepcopy(value)
+
+        self._record[field_name] = value
+        self._is_modified = True
+
+        return self
+
+    def add_to_field(self, field_name: str, value):
+        self._check_field(field_name)
+        self.resolve_deferred_field(field_name)
+
+        if field_name in USER_REF_FIELDS or field_name == 'urls':
+            value = to_uid(value)
+            if value not in self._record[field_name]:
+                self._record[field_name].append(value)
+        else:
+            self._record[field_name] += value
+
+        self._is_modified = True
+
+        return self
+
+    def sub_from_field(self, field_name: str, value):
+        self._check_field(field_name)
+        self.resolve_deferred_field(field_name)
+
+        if field_name in USER_REF_FIELDS or field_name == 'urls':
+            value = to_uid(value)
+            if value in self._record[field_name]:
+                self._record[field_name].remove(value)
+        else:
+            self._record[field_name] -= value
+
+        self._is_modified = True
+
+        return self
+
+    def load_deferred_fields(self, field_names: Iterable[str]):
+        self._record.update(self._storage.load_user_fields(self.uid, field_names))
+
+    def do_save(self):
+        self._storage.save_user(self)
+        self.mark_saved()
+
+    def do_delete(self):
+        self._storage.delete_user(self)
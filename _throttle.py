@@ -0,0 +1,141 @@
+"""PytSite Auth Plugin Sign In Attempts Throttling
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from typing import List, Optional
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from pytsite import reg, cache, router
+from . import _error
+
+_MAX_LOG_EXCESS = 64  # Failures kept above the limit, enough for the backoff to reach its maximum
+
+
+class MemoryStore:
+    """Bounded in-process attempts store
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._items = OrderedDict()  # key: (expires, value)
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] > time():
+                return item[1]
+
+    def put(self, key: str, value: dict, ttl: int):
+        with self._lock:
+            self._items[key] = (time() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(False)
+
+    def rm(self, key: str):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class CacheStore:
+    """Attempts store shared between processes
+    """
+
+    def __init__(self):
+        self._pool = cache.create_pool('auth.sign_in_throttle')
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            return self._pool.get(key)
+        except cache.error.KeyNotExist:
+            return None
+
+    def put(self, key: str, value: dict, ttl: int):
+        self._pool.put(key, value, ttl)
+
+    def rm(self, key: str):
+        try:
+            self._pool.rm(key)
+        except cache.error.KeyNotExist:
+            pass
+
+
+_enabled = reg.get('auth.sign_in_throttle_enabled', False)
+_window = reg.get('auth.sign_in_throttle_window', 900)  # seconds
+_max_attempts = {
+    'login': reg.get('auth.sign_in_throttle_max_login_attempts', 5),
+    'ip': reg.get('auth.sign_in_throttle_max_ip_attempts', 50),
+}
+_max_log_length = max(_max_attempts.values()) + _MAX_LOG_EXCESS
+_backoff = reg.get('auth.sign_in_throttle_backoff', 1)  # seconds
+_max_backoff = reg.get('auth.sign_in_throttle_max_backoff', 900)  # seconds
+if reg.get('auth.sign_in_throttle_store', 'memory') == 'cache':
+    _store = CacheStore()
+else:
+    _store = MemoryStore(reg.get('auth.sign_in_throttle_store_size', 100000))
+
+
+def get_keys(data: dict) -> List[str]:
+    """Get keys of attempts counters of a sign in request
+    """
+    keys = []
+
+    login = (data or {}).get('login')
+    if login:
+        keys.append('login:' + str(login).lower())
+
+    request = router.request()
+    if request and request.remote_addr:
+        keys.append('ip:' + request.remote_addr)
+
+    return keys
+
+
+def check(keys: List[str]):
+    """Reject an attempt if any of its counters is blocked
+    """
+    if not _enabled:
+        return
+
+    now = time()
+    for key in keys:
+        entry = _store.get(key)
+        if entry and entry['blocked_until'] > now:
+            raise _error.SignInThrottled(int(entry['blocked_until'] - now) + 1)
+
+
+def register_failure(keys: List[str]):
+    """Count a failed attempt
+    """
+    if not _enabled:
+        return
+
+    now = time()
+    for key in keys:
+        entry = _store.get(key) or {'failures': [], 'blocked_until': 0}
+
+        # Sliding window of recent failures
+        failures = [t for t in entry['failures'] if t > now - _window][-_max_log_length + 1:] + [now]
+
+        # Block for exponentially growing time once the limit is reached
+        excess = len(failures) - _max_attempts[key.split(':', 1)[0]]
+        blocked_until = now + min(_backoff * 2 ** excess, _max_backoff) if excess >= 0 else 0
+
+        _store.put(key, {'failures': failures, 'blocked_until': blocked_until}, _window + _max_backoff)
+
+
+def register_success(keys: List[str]):
+    """Forget failed attempts of the login
+
+    IP counters are kept, otherwise one valid account would be enough to reset them.
+    """
+    if not _enabled:
+        return
+
+    for key in keys:
+        if key.startswith('login:'):
+            _store.rm(key)
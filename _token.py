@@ -0,0 +1,151 @@
+"""PytSite Auth Plugin Access Tokens Internals
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import hmac
+import re
+import struct
+from typing import Any, Tuple, Union
+from datetime import datetime
+from binascii import Error as BinasciiError
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha256
+from time import time
+from pytsite import reg, util
+from . import _error
+
+_RECORD_V1 = 1
+_RECORD_V1_HEADER = struct.Struct('>BBIII')  # version, UID encoding, TTL, created, expires
+_UID_UTF8 = 0
+_UID_HEX = 1  # 24 hex digits UIDs, like MongoDB's ObjectIds, are packed into 12 bytes
+_HEX_UID_RE = re.compile('^[0-9a-f]{24}$')
+
+
+def _get_secret() -> bytes:
+    """Get access tokens signing secret
+    """
+    secret = reg.get('auth.access_token_secret')
+    if not secret:
+        raise RuntimeError("Configuration parameter 'auth.access_token_secret' is not set")
+
+    return secret.encode() if isinstance(secret, str) else secret
+
+
+def _b64encode(data: bytes) -> str:
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_get_secret(), payload.encode('ascii'), sha256).digest())
+
+
+def is_signed(token: str) -> bool:
+    """Check if the token is a signed one
+
+    Random tokens consist of alphanumeric characters only, so the separator is enough to distinguish them.
+    """
+    return '.' in token
+
+
+def get_signature(token: str) -> str:
+    """Get signature part of a signed token
+    """
+    return token.rsplit('.', 1)[-1]
+
+
+def sign(user_uid: str, created: int, expires: int) -> str:
+    """Generate a signed token
+    """
+    # Nonce makes tokens issued for the same user within the same second distinct
+    payload = _b64encode('{}:{}:{}:{}'.format(created, expires, util.random_str(8), user_uid).encode())
+
+    return '{}.{}'.format(payload, _sign(payload))
+
+
+def verify(token: str) -> Tuple[str, int, int]:
+    """Verify a signed token and return its user UID, creation and expiration timestamps
+    """
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            raise _error.InvalidAccessToken('Invalid access token')
+
+        created, expires, _, user_uid = _b64decode(payload).decode().split(':', 3)
+        created, expires = int(created), int(expires)
+
+    except (ValueError, TypeError, BinasciiError):
+        raise _error.InvalidAccessToken('Invalid access token')
+
+    if expires <= time():
+        raise _error.InvalidAccessToken('Access token has been expired')
+
+    return user_uid, created, expires
+
+
+def pack_info(token_info: dict) -> bytes:
+    """Pack token's metadata into a compact binary record
+    """
+    uid = token_info['user_uid']
+    if _HEX_UID_RE.match(uid):
+        uid_enc, uid_bytes = _UID_HEX, bytes.fromhex(uid)
+    else:
+        uid_enc, uid_bytes = _UID_UTF8, uid.encode()
+
+    header = _RECORD_V1_HEADER.pack(_RECORD_V1, uid_enc, token_info['ttl'], int(token_info['created'].timestamp()),
+                                    int(token_info['expires'].timestamp()))
+
+    return header + uid_bytes
+
+
+def _to_datetime(value: Any) -> datetime:
+    # Versions up to 3.17 stored expiration time of prolonged tokens as an 1-tuple
+    if isinstance(value, (tuple, list)):
+        value = value[0]
+
+    return value if isinstance(value, datetime) else datetime.fromtimestamp(float(value))
+
+
+def unpack_info(record: Union[bytes, dict]) -> dict:
+    """Unpack token's metadata
+
+    Metadata stored as dicts by previous versions is normalized. Raises ValueError if the record is malformed or has
+    an unsupported version.
+
+    >>> info = unpack_info({'user_uid': 'a', 'ttl': '60', 'created': datetime(2019, 7, 6),
+    ...                     'expires': (datetime(2019, 7, 7),)})
+    >>> info['ttl'], info['created'], info['expires']
+    (60, datetime.datetime(2019, 7, 6, 0, 0), datetime.datetime(2019, 7, 7, 0, 0))
+    """
+    if isinstance(record, dict):
+        try:
+            return {
+                'user_uid': str(record['user_uid']),
+                'ttl': int(record['ttl']),
+                'created': _to_datetime(record['created']),
+                'expires': _to_datetime(record['expires']),
+            }
+        except (KeyError, IndexError, TypeError, OverflowError, OSError):
+            raise ValueError('Malformed access token record')
+
+    if not isinstance(record, bytes) or not record or record[0] != _RECORD_V1:
+        raise ValueError('Unsupported access token record version')
+
+    try:
+        version, uid_enc, ttl, created, expires = _RECORD_V1_HEADER.unpack_from(record)
+    except struct.error:
+        raise ValueError('Malformed access token record')
+
+    uid_bytes = record[_RECORD_V1_HEADER.size:]
+
+    return {
+        'user_uid': uid_bytes.hex() if uid_enc == _UID_HEX else uid_bytes.decode(),
+        'ttl': ttl,
+        'created': datetime.fromtimestamp(created),
+        'expires': datetime.fromtimestamp(expires),
+    }